@@ -15,11 +15,20 @@
 
 - context.py : provides ability for poc modules to import telecortex module
 
+## Benchmarks:
+
+- bench_encoding.py : compare command formatting with the bytes-native encoder
+- bench_parsing.py : compare regex parsing of controller output with the compiled parser
+- bench_managers.py : compare the process manager with the thread pool manager
+
+## Recordings:
+
+- parallel_transcode.py : Record a video file using a pool of processes
+- parallel_gcode_player.py : Play a recording made by `transcode`
+
 ## Incomplete:
 
 - async.py : An attempt at asychronous which lost out to parallel
-- parallel_transcode.py | parallel_gcode_player.py : Given a video file,
-    convert to gcode with `transcode` so that it can be played with `gcode_player`
 - cortex_drivers.py : Something JVB was working on
 
 """
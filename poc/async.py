@@ -29,72 +29,72 @@ assert sys.version_info > (3, 7), (
     "must be running Python 3.7 or later to use asyncio")
 
 
-async def graphics(manager, conf):
-    # Frame number used for animations
-    frameno = 0
-    pixel_strs = {}
+def produce_frame(seq, maps, panels, do_single=False):
+    """
+    Render and encode frame `seq`. Runs in the manager's executor.
 
-    while manager.any_alive:
-        frameno = get_frameno()
-
-        pixel_strs = OrderedDict()
+    `panels` maps server_id to the (panel_number, size) of each panel.
+    """
+    # Frame number used for animations
+    frameno = get_frameno(seq)
 
-        if not conf.args.do_single:
-            for size, pix_map_normlized in conf.maps.items():
-                pixel_list = direct_rainbows(pix_map_normlized, frameno)
-                pixel_strs[size] = pix_array2text(*pixel_list)
+    pixel_strs = OrderedDict()
 
-        await manager.wait_for_workers_idle_async()
+    if not do_single:
+        for size, pix_map_normlized in maps.items():
+            pixel_list = direct_rainbows(pix_map_normlized, frameno)
+            pixel_strs[size] = pix_array2text(*pixel_list)
 
-        for server_id, server_panel_info in conf.panels.items():
-            if server_id not in manager.sessions:
-                logging.debug(
-                    "server id %s not found in manager coroutines: %s" % (
-                        server_id, manager.sessions.keys(),
-                    )
+    frame = []
+    for server_id, server_panel_info in panels.items():
+        for panel_number, size in server_panel_info:
+            if do_single:
+                pixel_str = pix_array2text(
+                    frameno, 255, 127
                 )
-                continue
-            if server_id not in manager.cmd_queues:
-                logging.debug(
-                    "server id %s not found in manager command queues: %s" % (
-                        server_id, manager.cmd_queues.keys(),
+                frame.append(
+                    (server_id, "M2603", {"Q": panel_number}, pixel_str))
+            else:
+                assert size in pixel_strs, \
+                    (
+                        "Your panel configuration specifies a size %s but "
+                        "your map configuration does not contain a "
+                        "matching entry, only %s"
+                    ) % (
+                        size, maps.keys()
                     )
-                )
-                continue
+                pixel_str = pixel_strs.get(size)
+                if not pixel_str:
+                    logging.warning(
+                        "empty pixel_str generated: %s" % pixel_str)
+                frame.append(
+                    (server_id, "M2600", {"Q": panel_number}, pixel_str))
 
-            for panel_number, size in server_panel_info:
-                if conf.args.do_single:
-                    pixel_str = pix_array2text(
-                        frameno, 255, 127
-                    )
-                    await manager.chunk_payload_with_linenum_async(
-                        server_id,
-                        "M2603", {"Q": panel_number}, pixel_str
-                    )
-                else:
-                    assert size in pixel_strs, \
-                        (
-                            "Your panel configuration specifies a size %s but "
-                            "your map configuration does not contain a "
-                            "matching entry, only %s"
-                        ) % (
-                            size, conf.maps.keys()
-                        )
-                    pixel_str = pixel_strs.get(size)
-                    if not pixel_str:
-                        logging.warning(
-                            "empty pixel_str generated: %s" % pixel_str)
-
-                    await manager.chunk_payload_with_linenum_async(
-                        server_id,
-                        "M2600", {"Q": panel_number}, pixel_str
-                    )
+        logging.debug("gfx %s fn %s" % (server_id, frameno))
+    return frame
 
-            logging.debug("gfx %s fn %s" % (server_id, frameno))
 
-            await manager.chunk_payload_with_linenum_async(
-                server_id, "M2610", None, None
+async def graphics(manager, conf):
+    panels = OrderedDict()
+    for server_id, server_panel_info in conf.panels.items():
+        if server_id not in manager.sessions:
+            logging.debug(
+                "server id %s not found in manager coroutines: %s" % (
+                    server_id, manager.sessions.keys(),
+                )
             )
+            continue
+        if server_id not in manager.cmd_queues:
+            logging.debug(
+                "server id %s not found in manager command queues: %s" % (
+                    server_id, manager.cmd_queues.keys(),
+                )
+            )
+            continue
+        panels[server_id] = server_panel_info
+
+    await manager.run_frame_producer_async(
+        produce_frame, conf.maps, panels, conf.args.do_single)
 
 
 def main():
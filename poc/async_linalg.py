@@ -33,58 +33,70 @@ from telecortex.util import pix_array2text
 # INTERPOLATION_TYPE = 'bilinear'
 INTERPOLATION_TYPE = 'nearest'
 
-async def graphics(manager, conf):
-    pixel_map_cache = OrderedDict()
-    pixel_str_cache = OrderedDict()
+def produce_frame(seq, panel_maps):
+    """
+    Render, sample and encode frame `seq`. Runs in the manager's executor.
 
+    `panel_maps` is a list of (server_id, panel_number, panel_map).
+    """
+    img = get_square_canvas()
+    fill_rainbows(img, get_frameno(seq))
+
+    frame = []
+    for server_id, panel_number, panel_map in panel_maps:
+        pixel_list = interpolate_pixel_map(
+            img, panel_map, INTERPOLATION_TYPE
+        )
+        frame.append((
+            server_id, "M2600", {"Q": panel_number},
+            pix_array2text(*pixel_list)
+        ))
+    return frame
+
+
+def render_preview(seq):
+    """
+    Render frame `seq` for the preview. Runs in the manager's executor.
+    """
     img = get_square_canvas()
+    fill_rainbows(img, get_frameno(seq))
+    return img
 
-    if conf.args.enable_preview:
-        cv2_setup_main_window(img)
 
+async def preview(manager, conf):
+    """
+    Show a preview of the last frame sent, a few times a second. Only the
+    window is updated on the event loop, the frame is rendered in the
+    manager's executor.
+    """
+    cv2_setup_main_window(get_square_canvas())
     while manager.any_alive:
-        frameno = get_frameno()
-        fill_rainbows(img, frameno)
-
-        for server_id, server_panel_info in conf.panels.items():
-            if server_id not in manager.sessions:
-                continue
-            for panel_number, map_name in server_panel_info:
-                if (server_id, panel_number) not in pixel_map_cache.keys():
-                    if map_name not in conf.maps:
-                        raise UserWarning(
-                            'Panel map_name %s not in known mappings: %s' % (
-                                map_name, conf.maps.keys()
-                            )
-                        )
-                    panel_map = conf.maps[map_name]
-
-                    pixel_map_cache[(server_id, panel_number)] = panel_map
-
-                panel_map = pixel_map_cache.get((server_id, panel_number))
-
-                pixel_list = interpolate_pixel_map(
-                    img, panel_map, INTERPOLATION_TYPE
+        img = await manager.run_in_executor_async(
+            render_preview, max(manager.frame_seq, 0))
+        if cv2_show_preview(img, conf.maps):
+            break
+        await asyncio.sleep(0.2)
+
+
+async def graphics(manager, conf):
+    panel_maps = []
+    for server_id, server_panel_info in conf.panels.items():
+        if server_id not in manager.sessions:
+            continue
+        for panel_number, map_name in server_panel_info:
+            if map_name not in conf.maps:
+                raise UserWarning(
+                    'Panel map_name %s not in known mappings: %s' % (
+                        map_name, conf.maps.keys()
+                    )
                 )
-                pixel_str_cache[(server_id, panel_number)] = \
-                    pix_array2text(*pixel_list)
-
-        await manager.wait_for_workers_idle_async()
-
-        for (server_id, panel_number), pixel_str in pixel_str_cache.items():
-            await manager.chunk_payload_with_linenum_async(
-                server_id,
-                "M2600", {"Q": panel_number}, pixel_str
-            )
-        for server_id, server_panel_info in conf.panels.items():
-            if server_id not in manager.sessions:
-                continue
-            await manager.chunk_payload_with_linenum_async(
-                server_id, 'M2610', None, None)
-
-        if conf.args.enable_preview:
-            if cv2_show_preview(img, conf.maps):
-                break
+            panel_maps.append(
+                (server_id, panel_number, conf.maps[map_name]))
+
+    coroutines = [manager.run_frame_producer_async(produce_frame, panel_maps)]
+    if conf.args.enable_preview:
+        coroutines.append(preview(manager, conf))
+    await asyncio.gather(*coroutines)
 
 def main():
     logging.getLogger('asyncio').setLevel(logging.DEBUG)
@@ -0,0 +1,110 @@
+"""
+Micro-benchmark command encoding: `TelecortexCommand.fmt` vs `TelecortexEncoder`.
+"""
+
+import logging
+import timeit
+
+import numpy as np
+from kitchen.text import converters
+
+from context import telecortex
+from telecortex.encoding import TelecortexEncoder, xor_prefix
+from telecortex.session import PANEL_LENGTHS, TelecortexLineCommand
+from telecortex.util import pix_array2text
+
+REPEATS = 2000
+PIXELS_PER_CHUNK = 50
+
+
+def random_payload(panel_length):
+    pixels = np.random.randint(0, 256, panel_length * 3)
+    return pix_array2text(*pixels)
+
+
+def panel_chunks(payload):
+    """
+    Generate the (linenum, cmd, args) of each chunk of a panel payload.
+    """
+    chunks = []
+    for linenum, start in enumerate(
+        range(0, len(payload), PIXELS_PER_CHUNK * 4)
+    ):
+        args = {'Q': 0}
+        if start:
+            args['S'] = start // 4
+        args['V'] = payload[start:start + PIXELS_PER_CHUNK * 4]
+        chunks.append((linenum + 1000, "M2600", args))
+    return chunks
+
+
+def encode_fmt(chunks):
+    return [
+        converters.to_bytes(
+            TelecortexLineCommand(linenum, cmd, args).fmt(checksum=True) + '\n'
+        )
+        for linenum, cmd, args in chunks
+    ]
+
+
+def encode_encoder(encoder, chunks):
+    return [
+        TelecortexLineCommand(linenum, cmd, args).encode(encoder)
+        for linenum, cmd, args in chunks
+    ]
+
+
+def encode_prefixed(encoder, payloads):
+    """
+    Encode each payload using cached headers and a single cumulative XOR.
+    """
+    response = []
+    for payload in payloads:
+        payload = payload.encode('ascii')
+        prefix = xor_prefix(payload)
+        for linenum, start in enumerate(
+            range(0, len(payload), PIXELS_PER_CHUNK * 4)
+        ):
+            end = min(start + PIXELS_PER_CHUNK * 4, len(payload))
+            args = {'Q': 0}
+            if start:
+                args['S'] = start // 4
+            args['V'] = None
+            header, header_checksum = encoder.get_header("M2600", args)
+            response.append(encoder.encode_parts(
+                linenum + 1000, header, header_checksum,
+                payload[start:end], prefix[start] ^ prefix[end]
+            ))
+    return response
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    encoder = TelecortexEncoder(do_crc=True)
+    payloads = [random_payload(length) for length in PANEL_LENGTHS]
+    chunks = []
+    for payload in payloads:
+        chunks.extend(panel_chunks(payload))
+
+    expected = encode_fmt(chunks)
+    assert expected == encode_encoder(encoder, chunks), \
+        "encoder output does not match fmt output"
+    assert expected == encode_prefixed(encoder, payloads), \
+        "prefixed encoder output does not match fmt output"
+
+    for name, func in [
+        ('fmt + add_checksum + to_bytes', lambda: encode_fmt(chunks)),
+        ('TelecortexEncoder', lambda: encode_encoder(encoder, chunks)),
+        ('TelecortexEncoder + xor_prefix',
+         lambda: encode_prefixed(encoder, payloads)),
+    ]:
+        elapsed = min(timeit.repeat(func, number=REPEATS, repeat=3))
+        logging.info(
+            "%-32s %8.2f us / chunk" % (
+                name, elapsed * 1e6 / (REPEATS * len(chunks))
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
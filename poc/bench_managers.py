@@ -0,0 +1,110 @@
+"""
+Benchmark the process manager against the thread pool manager with virtual
+controllers: startup time, memory and frame rate.
+"""
+
+import logging
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+
+from context import telecortex
+from telecortex.manage import (TeleCortexVirtualThreadManager,
+                               TeleCortexVirtualThreadPoolManager)
+from telecortex.session import PANEL_LENGTHS
+from telecortex.util import pix_array2text
+
+CONTROLLER_COUNTS = [1, 5, 10]
+FRAMES = 100
+
+
+def random_payloads():
+    return [
+        pix_array2text(*np.random.randint(0, 256, length * 3))
+        for length in PANEL_LENGTHS
+    ]
+
+
+def get_memory(pid):
+    """
+    Proportional set size of a process in bytes, so that pages shared after
+    a fork are not counted more than once.
+    """
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as smaps:
+            for line in smaps:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return 0
+
+
+def get_total_memory():
+    pids = [os.getpid()] + [proc.pid for proc in mp.active_children()]
+    return sum([get_memory(pid) for pid in pids])
+
+
+def wait_for_commit(manager):
+    """
+    Wait until every controller has committed the last frame.
+    """
+    while manager.skew_seq != manager.commit_seq:
+        manager.update_commit_skew()
+        time.sleep(0.0005)
+
+
+def send_frame(manager, payloads):
+    for server_id in manager.sessions.keys():
+        for panel_number, payload in enumerate(payloads):
+            manager.chunk_payload_with_linenum(
+                server_id, "M2600", {"Q": panel_number}, payload
+            )
+    manager.commit_frame()
+
+
+def bench(manager_class, controllers, payloads):
+    servers = dict([
+        (server_id, {'file': 'VIRTUAL_%d' % server_id})
+        for server_id in range(controllers)
+    ])
+    memory_start = get_total_memory()
+
+    start = time.time()
+    manager = manager_class(servers)
+    send_frame(manager, payloads)
+    wait_for_commit(manager)
+    startup = time.time() - start
+    memory = get_total_memory() - memory_start
+
+    start = time.time()
+    for _ in range(FRAMES):
+        send_frame(manager, payloads)
+    wait_for_commit(manager)
+    fps = FRAMES / (time.time() - start)
+
+    manager.close()
+    return startup, memory, fps
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    payloads = random_payloads()
+    logging.info("%-36s %11s %9s %11s %8s" % (
+        'manager', 'controllers', 'startup', 'memory', 'fps'))
+    for controllers in CONTROLLER_COUNTS:
+        for manager_class in [
+            TeleCortexVirtualThreadManager,
+            TeleCortexVirtualThreadPoolManager,
+        ]:
+            startup, memory, fps = bench(manager_class, controllers, payloads)
+            logging.info("%-36s %11d %8.3fs %8.1f MB %8.1f" % (
+                manager_class.__name__, controllers, startup,
+                memory / 1e6, fps
+            ))
+
+
+if __name__ == '__main__':
+    main()
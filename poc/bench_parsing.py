@@ -0,0 +1,136 @@
+"""
+Benchmark parsing of controller output: uncompiled regexes vs TelecortexResponseParser.
+"""
+
+import argparse
+import logging
+import re
+import timeit
+
+from context import telecortex
+from telecortex.parsing import TelecortexResponseParser
+
+REPEATS = 200
+
+# Synthetic controller output, written by hand in the format the firmware
+# uses, for a controller receiving a rainbow on 4 panels, including a
+# checksum error and the resend request which follows it. Output recorded
+# from a real controller can be benchmarked instead with --capture.
+DEVICE_OUTPUT = b"""\
+;SET: PANELS: 4, PANEL_INFO: 0: 316, 1: 260, 2: 260, 3: 260
+N0: OK
+N1: S3
+N2: OK
+N3: OK
+N4: OK
+N5: OK
+N6: OK
+N7: OK
+;LOO: FPS:   28.35, CMD_RATE:  1157.41 cps, PIX_RATE:  31851.85 pps, QUEUE: 3/20
+N8: OK
+N9: OK
+N10: OK
+N11: OK
+N12 E10: checksum mismatch, expected 98, calculated 74
+RS 12
+N12: OK
+N13: OK
+N14: OK
+N15: OK
+IDLE
+N16: OK
+N17: OK
+N18: OK
+;LOO: FPS:   29.01, CMD_RATE:  1202.88 cps, PIX_RATE:  32590.04 pps, QUEUE: 1/20
+N19: OK
+N20: OK
+IDLE
+"""
+
+RE_ERROR = r"^E(?P<errnum>\d+):\s*(?P<err>.*)"
+RE_LINE = r"^N(?P<linenum>\d+)"
+RE_LINE_OK = r"%s:\s*OK" % RE_LINE
+RE_LINE_ERROR = r"%s\s*" % RE_LINE + RE_ERROR[1:]
+RE_LINE_RESPONSE = r"%s:\s*(?P<response>\S+)" % RE_LINE
+RE_RESEND = r"^RS\s+(?P<linenum>\d+)"
+RE_SET = r"^;SET: "
+RE_LOO_RATES = (
+    r"^;LOO: "
+    r"FPS:\s+(?P<fps>[\d\.]+),?\s*"
+    r"CMD_RATE:\s+(?P<cmd_rate>[\d\.]+)\s*cps,?\s*"
+    r"PIX_RATE:\s+(?P<pix_rate>[\d\.]+)\s*pps,?\s*"
+    r"QUEUE:\s+(?P<queue_occ>\d+)\s*/\s*(?P<queue_max>\d+)"
+)
+
+
+def legacy_parse(line):
+    """
+    Parse a line the way TelecortexBaseSession.parse_response used to.
+    """
+    if line.startswith("IDLE"):
+        return 'IDLE', {}
+    elif line.startswith(";"):
+        if re.match(RE_LOO_RATES, line):
+            return 'LOO', re.search(RE_LOO_RATES, line).groupdict()
+        elif re.match(RE_SET, line):
+            return 'SET', {}
+    elif line.startswith("N"):
+        if re.match(RE_LINE_OK, line):
+            return 'LINE_OK', re.search(RE_LINE_OK, line).groupdict()
+        elif re.match(RE_LINE_ERROR, line):
+            return 'LINE_ERROR', re.search(RE_LINE_ERROR, line).groupdict()
+        elif re.match(RE_LINE_RESPONSE, line):
+            return (
+                'LINE_RESPONSE',
+                re.search(RE_LINE_RESPONSE, line).groupdict()
+            )
+    elif line.startswith("E"):
+        if re.match(RE_ERROR, line):
+            return 'ERROR', re.search(RE_ERROR, line).groupdict()
+    elif line.startswith("RS"):
+        if re.match(RE_RESEND, line):
+            return 'RESEND', re.search(RE_RESEND, line).groupdict()
+    return 'UNKNOWN', {}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        '--capture', default=None,
+        help=(
+            "file of output recorded from a controller, e.g. with "
+            "`cat /dev/ttyACM0 > capture.txt`, instead of DEVICE_OUTPUT"))
+    args = arg_parser.parse_args()
+    device_output = DEVICE_OUTPUT
+    if args.capture:
+        with open(args.capture, 'rb') as capture:
+            device_output = capture.read()
+    parser = TelecortexResponseParser()
+    byte_lines = [line for line in device_output.splitlines() if line]
+    text_lines = [
+        line.decode('ascii', errors='replace') for line in byte_lines]
+
+    assert \
+        [kind for kind, _ in map(legacy_parse, text_lines)] == \
+        [kind for kind, _ in parser.parse_lines(byte_lines)], \
+        "parser does not classify lines the same way as legacy_parse"
+
+    for name, func in [
+        ('legacy re.match + re.search',
+         lambda: [legacy_parse(line) for line in text_lines]),
+        ('TelecortexResponseParser (str)',
+         lambda: parser.parse_lines(text_lines)),
+        ('TelecortexResponseParser (bytes)',
+         lambda: parser.parse_lines(byte_lines)),
+    ]:
+        elapsed = min(timeit.repeat(func, number=REPEATS, repeat=3))
+        logging.info(
+            "%-34s %8.2f us / line" % (
+                name, elapsed * 1e6 / (REPEATS * len(byte_lines))
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
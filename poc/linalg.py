@@ -69,10 +69,7 @@ def graphics(manager, conf):
                 server_id,
                 "M2600", {"Q": panel_number}, pixel_str
             )
-        for server_id, server_panel_info in conf.panels.items():
-            if server_id not in manager.sessions:
-                continue
-            manager.chunk_payload_with_linenum(server_id, 'M2610', None, None)
+        manager.commit_frame()
 
         if conf.args.enable_preview:
             if cv2_show_preview(img, conf.maps):
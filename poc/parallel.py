@@ -70,8 +70,7 @@ def graphics(manager, conf):
                         "M2600", {"Q": panel_number}, pixel_str
                     )
 
-        for server_id in manager.sessions.keys():
-            manager.chunk_payload_with_linenum(server_id, "M2610", None, None)
+        manager.commit_frame()
 
 def main():
 
@@ -1,74 +1,49 @@
 
-import itertools
-import json
 import logging
-import multiprocessing as mp
-import os
-import re
-import sys
-from collections import OrderedDict
-from datetime import datetime
-from time import time as time_now
 
-import serial
-
-import coloredlogs
-import cv2
-import numpy as np
 from context import telecortex
-from mss import mss
 from telecortex.config import TeleCortexThreadManagerConfig
-from telecortex.util import pix_array2text
-
-TARGET_FRAMERATE = 20
-ANIM_SPEED = 2
-MAIN_WINDOW = 'image_window'
-# INTERPOLATION_TYPE = 'bilinear'
-INTERPOLATION_TYPE = 'nearest'
-DOT_RADIUS = 1
-INTERLEAVE = False
+from telecortex.recording import (TelecortexRecording,
+                                  TelecortexRecordingPlayer)
 
 # TODO: put this in config
-GCODE_FILE = "BOKK.gcode"
+RECORDING_FILE = "BOKK.tcrec"
 
-RE_GCODE_LINE = "(?P<server_id>\d+): (?P<cmd>\S+), (?P<args>.*), (?P<payload>\S+)"
 
 def main():
 
     conf = TeleCortexThreadManagerConfig(
         name="parallel_gcode_player",
         description=(
-            "play a gcode file to several telecortex controllers in parallel"),
+            "play a recording to several telecortex controllers in parallel"),
         default_config='dome_overhead'
     )
 
-    conf.parse_args()
-
-    manager = conf.setup_manager()
+    conf.parser.add_argument('--recording', default=RECORDING_FILE,
+                             help="recording made by parallel_transcode")
+    conf.parser.add_argument('--loop', default=False, action='store_true',
+                             help="restart the recording when it ends")
+    conf.parser.add_argument('--rate', default=1.0, type=float,
+                             help="playback speed relative to the recording")
+    conf.parser.add_argument('--seek', default=0, type=int,
+                             help="frame to start playing from")
 
-    with open(GCODE_FILE) as gcode_file:
-        while manager.any_alive:
-            line = gcode_file.readline()
-            try:
-                matchdict = re.search(RE_GCODE_LINE, line).groupdict()
-            except Exception as exc:
-                logging.error("lines does not match: %s" % line)
-                raise exc
+    conf.parse_args()
 
-            server_id = int(matchdict.get('server_id'))
-            cmd = matchdict.get('cmd')
-            str_args = matchdict.get('args')
-            payload = matchdict.get('payload')
-            args = json.loads(str_args)
+    recording = TelecortexRecording(conf.args.recording)
+    logging.info("playing %d frames from %s" % (
+        len(recording), conf.args.recording))
 
-            manager.chunk_payload_with_linenum(
-                server_id,
-                cmd, args, payload
-            )
-            # TODO: manager.wait_for_workers_idle()
+    manager = conf.setup_manager()
 
-            while not manager.all_idle:
-                logging.debug("waiting on queue")
+    player = TelecortexRecordingPlayer(
+        manager, recording, rate=conf.args.rate, loop=conf.args.loop
+    )
+    try:
+        player.play(conf.args.seek)
+    finally:
+        manager.close()
+        recording.close()
 
 
 if __name__ == '__main__':
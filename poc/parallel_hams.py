@@ -72,8 +72,7 @@ def graphics(manager, conf):
 
         manager.wait_for_workers_idle()
 
-        for server_id in manager.sessions.keys():
-            manager.chunk_payload_with_linenum(server_id, "M2610", None, None)
+        manager.commit_frame()
 
         if conf.args.enable_preview:
             if cv2_show_preview(img, pixel_map_cache):
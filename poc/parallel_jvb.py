@@ -94,8 +94,7 @@ def main():
 
         manager.wait_for_workers_idle()
 
-        for server_id in manager.sessions.keys():
-            manager.chunk_payload_with_linenum(server_id, "M2610", None, None)
+        manager.commit_frame()
 
 
 if __name__ == '__main__':
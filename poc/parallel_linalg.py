@@ -29,6 +29,38 @@ INTERPOLATION_TYPE = 'nearest'
 INTERLEAVE = False
 
 
+def canvas_graphics(manager, conf):
+    """
+    Render into the manager's shared canvas, and leave sampling and encoding
+    to each controller process.
+    """
+    if conf.args.enable_preview:
+        cv2_setup_main_window(manager.get_canvas())
+
+    while manager.any_alive:
+        frameno = get_frameno()
+        img = manager.get_canvas()
+        fill_rainbows(img, frameno)
+        manager.commit_canvas()
+
+        if conf.args.enable_preview:
+            if cv2_show_preview(img, conf.maps):
+                break
+
+
+def get_canvas_panels(conf):
+    """
+    Map each server_id to the (panel_number, pixel map) of its panels.
+    """
+    canvas_panels = OrderedDict()
+    for server_id, server_panel_info in conf.panels.items():
+        canvas_panels[server_id] = [
+            (panel_number, conf.maps[map_name])
+            for panel_number, map_name in server_panel_info
+        ]
+    return canvas_panels
+
+
 def main():
     telecortex.graphics.IMG_SIZE = 128
     telecortex.graphics.DOT_RADIUS = 1
@@ -42,14 +74,29 @@ def main():
     )
     conf.parser.add_argument('--enable-preview', default=False,
                              action='store_true')
+    conf.parser.add_argument(
+        '--shared-canvas', default=False, action='store_true',
+        help="sample and encode panels in each controller process")
 
     conf.parse_args()
 
     logging.debug("\n\n\nnew session at %s" % datetime.now().isoformat())
 
-    manager = conf.setup_manager()
+    if not conf.args.shared_canvas:
+        manager = conf.setup_manager()
+        graphics(manager, conf)
+        return
 
-    graphics(manager, conf)
+    img_size = telecortex.graphics.IMG_SIZE
+    manager = conf.setup_manager(
+        canvas_shape=(img_size, img_size, 3),
+        canvas_panels=get_canvas_panels(conf),
+        canvas_interp_type=INTERPOLATION_TYPE
+    )
+    try:
+        canvas_graphics(manager, conf)
+    finally:
+        manager.close()
 
 
 if __name__ == '__main__':
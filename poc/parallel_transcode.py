@@ -1,127 +1,146 @@
+"""
+Transcode a video into a recording which can be played with
+parallel_gcode_player.
+
+The video is split into ranges of frames which are decoded, sampled and
+encoded by a pool of processes. Each process writes its range to a segment
+file, and the segments are appended to the recording in order.
+"""
 
-import itertools
 import logging
 import multiprocessing as mp
 import os
-import sys
-from collections import OrderedDict
-from datetime import datetime
 from time import time as time_now
 
-import serial
-
-import coloredlogs
 import cv2
 import numpy as np
 from context import telecortex
-from mss import mss
 from telecortex.config import TeleCortexConfig
-from telecortex.graphics import (MAIN_WINDOW, cv2_draw_map,
-                                 cv2_setup_main_window, cv2_show_preview)
-from telecortex.interpolation import interpolate_pixel_map
-from telecortex.manage import TeleCortexCacheManager
-from telecortex.mapping import (PANELS_PER_CONTROLLER, normalize_pix_map,
-                                rotate_mapping, rotate_vector, scale_mapping,
-                                transform_panel_map, transpose_mapping)
-from telecortex.util import pix_array2text
+from telecortex.interpolation import (get_nearest_sampler,
+                                      interpolate_pixel_map)
+from telecortex.mapping import transform_panel_map
+from telecortex.recording import TelecortexRecorder
 
 # INTERPOLATION_TYPE = 'bilinear'
 INTERPOLATION_TYPE = 'nearest'
-INTERLEAVE = False
 # TODO: add this to config
 VIDEO_FILE = "/Users/derwent/Movies/Telecortex/loops/BOKK (loop).mov"
+RECORDING_FILE = "BOKK.tcrec"
+# Frame rate to assume if the video does not say
+DEFAULT_FPS = 30.0
+
+
+def get_panel_maps(conf):
+    """
+    Transform the map of each panel into a list of
+    (server_id, panel_number, panel_map).
+    """
+    panel_maps = []
+    for server_id, server_panel_info in conf.panels.items():
+        for panel_number, size, scale, angle, offset in server_panel_info:
+            if size not in conf.maps:
+                raise UserWarning(
+                    'Panel size %s not in known mappings: %s' % (
+                        size, conf.maps.keys()
+                    )
+                )
+            panel_map = transform_panel_map(
+                conf.maps[size], size, scale, angle, offset)
+            panel_maps.append((server_id, panel_number, panel_map))
+    return panel_maps
+
+
+def transcode_range(job):
+    """
+    Record frames `first` to `last` of a video to a segment file.
+
+    Return the segment file and the frames of its recorder, for
+    `TelecortexRecorder.append_segment`.
+    """
+    (video_file, segment_file, first, last, fps, panel_maps,
+     interp_type) = job
+    cap = cv2.VideoCapture(video_file)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+    recorder = TelecortexRecorder(segment_file, write_index=False)
+    for frame in range(first, last):
+        ret, img = cap.read()
+        if not ret:
+            break
+        timestamp = frame / fps
+        for server_id, panel_number, panel_map in panel_maps:
+            if interp_type == 'nearest':
+                pixels = get_nearest_sampler(panel_map, img.shape).sample(img)
+            else:
+                pixels = np.array(
+                    interpolate_pixel_map(img, panel_map, interp_type),
+                    dtype=np.uint8
+                )
+            recorder.record_pixels(
+                server_id, "M2600", {"Q": panel_number}, pixels.tobytes(),
+                timestamp
+            )
+        recorder.record_commit(timestamp)
+    cap.release()
+    recorder.close()
+    return segment_file, recorder.frames
 
-def main():
 
-    telecortex.graphics.DOT_RADIUS = 1
+def main():
 
-    conf = TeleCortexThreadManagerConfig(
-        name="parallel_linalg",
+    conf = TeleCortexConfig(
+        name="parallel_transcode",
         description=(
-            "draw a single rainbow spanning several telecortex controllers in "
-            "parallel"),
+            "transcode a video into a recording for several telecortex "
+            "controllers, using several processes"),
         default_config='dome_overhead'
     )
 
-    conf.parser.add_argument('--enable-preview', default=False,
-                             action='store_true')
+    conf.parser.add_argument('--video', default=VIDEO_FILE)
+    conf.parser.add_argument('--recording', default=RECORDING_FILE)
+    conf.parser.add_argument('--processes', default=mp.cpu_count(), type=int)
+    conf.parser.add_argument('--range-frames', default=100, type=int,
+                             help="number of frames transcoded by each job")
+    conf.parser.add_argument('--interp-type', default=INTERPOLATION_TYPE,
+                             choices=['nearest', 'bilinear'])
 
     conf.parse_args()
 
-    manager = TeleCortexCacheManager(conf.servers, 'BOKK.gcode')
-
-    cap = cv2.VideoCapture(VIDEO_FILE)
-    ret, img = cap.read()
-
-    if conf.args.enable_preview:
-        cv2_setup_main_window(img)
-
-    pixel_map_cache = OrderedDict()
+    cap = cv2.VideoCapture(conf.args.video)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+    cap.release()
+    if frame_count <= 0:
+        raise UserWarning("could not read video: %s" % conf.args.video)
+
+    panel_maps = get_panel_maps(conf)
+    jobs = [
+        (
+            conf.args.video, "%s.%d.part" % (conf.args.recording, first),
+            first, min(first + conf.args.range_frames, frame_count), fps,
+            panel_maps, conf.args.interp_type
+        )
+        for first in range(0, frame_count, conf.args.range_frames)
+    ]
+    logging.info("transcoding %d frames in %d jobs on %d processes" % (
+        frame_count, len(jobs), conf.args.processes))
 
     start_time = time_now()
-
-    while manager.any_alive:
-
-        cv2.imshow(MAIN_WINDOW, np.array(img))
-
-        for server_id, server_panel_info in conf.panels.items():
-            if not manager.session_active(server_id):
-                continue
-            for panel_number, size, scale, angle, offset in server_panel_info:
-                if (server_id, panel_number) not in pixel_map_cache.keys():
-                    if size not in conf.maps:
-                        raise UserWarning(
-                            'Panel size %s not in known mappings: %s' % (
-                                size, conf.maps.keys()
-                            )
-                        )
-                    panel_map = conf.maps[size]
-                    panel_map = transform_panel_map(
-                        panel_map, size, scale, angle, offset)
-
-                    pixel_map_cache[(server_id, panel_number)] = panel_map
-
-                if INTERLEAVE:
-                    continue
-                panel_map = pixel_map_cache.get((server_id, panel_number))
-
-                pixel_list = interpolate_pixel_map(
-                    img, panel_map, INTERPOLATION_TYPE
-                )
-                pixel_str = pix_array2text(*pixel_list)
-                manager.chunk_payload_with_linenum(
-                    server_id,
-                    "M2600", {"Q": panel_number}, pixel_str
-                )
-
-        if INTERLEAVE:
-            for panel_number in range(PANELS_PER_CONTROLLER):
-                for server_id in conf.panels.keys():
-                    panel_map = pixel_map_cache.get((server_id, panel_number))
-                    if not panel_map:
-                        continue
-
-                    pixel_list = interpolate_pixel_map(
-                        img, panel_map, INTERPOLATION_TYPE
-                    )
-                    pixel_str = pix_array2text(*pixel_list)
-
-                    manager.chunk_payload_with_linenum(
-                        server_id,
-                        "M2600", {"Q": panel_number}, pixel_str
-                    )
-
-        while not manager.all_idle:
-            logging.debug("waiting on queue")
-
-        for server_id in manager.servers.keys():
-            manager.chunk_payload_with_linenum(server_id, "M2610", None, None)
-
-        if conf.args.enable_preview:
-            if cv2_show_preview(img, pixel_map_cache):
-                break
-
-        ret, img = cap.read()
+    recorder = TelecortexRecorder(conf.args.recording)
+    pool = mp.Pool(conf.args.processes)
+    try:
+        for segment_file, frames in pool.imap(transcode_range, jobs):
+            recorder.append_segment(segment_file, frames)
+            os.remove(segment_file)
+            logging.info("transcoded %d / %d frames" % (
+                len(recorder.frames), frame_count))
+    finally:
+        pool.terminate()
+        recorder.close()
+
+    elapsed = time_now() - start_time
+    logging.warning(
+        "transcoded %.1fs of video in %.1fs, %.2fx realtime" % (
+            frame_count / fps, elapsed, frame_count / fps / elapsed))
 
 
 if __name__ == '__main__':
@@ -4,6 +4,18 @@ Package for sending image data to a TeleCortex Server.
 Session:
     Manage sessions with servers
 
+Encoding:
+    Encode commands as bytes
+
+Parsing:
+    Parse lines received from servers
+
+Canvas:
+    Share rendered frames between processes
+
+Recording:
+    Record and replay the commands sent to servers
+
 Util:
     Utility methods
 """
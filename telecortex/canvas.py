@@ -0,0 +1,80 @@
+"""
+Share rendered frames between processes without copying them.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class TelecortexSharedCanvas(object):
+    """
+    A double buffered image in `multiprocessing.shared_memory`.
+
+    The producer renders frame `seq` into `get_buffer(seq)` while consumers
+    are still sampling frame `seq - 1` from the other buffer. The sequence
+    number of the frame in each buffer is stored alongside it, so consumers
+    can tell if a buffer was overwritten while they were sampling it.
+    """
+
+    buffer_count = 2
+
+    def __init__(self, shape, name=None):
+        self.shape = tuple(shape)
+        frame_size = int(np.prod(self.shape))
+        seqs_size = self.buffer_count * np.dtype(np.int64).itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=seqs_size + self.buffer_count * frame_size
+            )
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        # Sequence number of the frame in each buffer
+        self.seqs = np.ndarray(
+            (self.buffer_count,), dtype=np.int64, buffer=self.shm.buf
+        )
+        self.buffers = np.ndarray(
+            (self.buffer_count,) + self.shape, dtype=np.uint8,
+            buffer=self.shm.buf, offset=seqs_size
+        )
+        if self.owner:
+            self.seqs[:] = -1
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @classmethod
+    def attach(cls, name, shape):
+        """
+        Attach to a canvas created by another process.
+        """
+        return cls(shape, name)
+
+    def get_buffer(self, seq):
+        """
+        Get the image which frame `seq` is rendered into.
+        """
+        return self.buffers[seq % self.buffer_count]
+
+    def set_seq(self, seq):
+        """
+        Mark frame `seq` as completely rendered.
+        """
+        self.seqs[seq % self.buffer_count] = seq
+
+    def get_seq(self, seq):
+        """
+        Get the sequence number of the frame in the buffer for frame `seq`.
+        """
+        return int(self.seqs[seq % self.buffer_count])
+
+    def close(self):
+        # Views of the buffer have to be released before it can be closed.
+        del self.seqs
+        del self.buffers
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
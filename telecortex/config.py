@@ -11,15 +11,17 @@ import coloredlogs
 from telecortex.manage import (TelecortexAsyncManager,
                                TelecortexSessionManager,
                                TelecortexThreadManager,
+                               TelecortexThreadPoolManager,
                                TelecortexVirtualManager,
-                               TeleCortexVirtualThreadManager)
+                               TeleCortexVirtualThreadManager,
+                               TeleCortexVirtualThreadPoolManager)
 from telecortex.mapping import (MAPS_DOME_DJ, MAPS_DOME_OVERHEAD,
                                 MAPS_DOME_SIMPLIFIED, MAPS_DOME_TRIFORCE,
                                 MAPS_GOGGLE, MAPS_TRIFORCE, PANELS_DOME_DJ,
                                 PANELS_DOME_OVERHEAD, PANELS_DOME_SIMPLIFIED,
                                 PANELS_DOME_TRIFORCE, PANELS_GOGGLE,
                                 PANELS_TRIFORCE)
-from telecortex.ser import SERVERS_DOME, SERVERS_SINGLE
+from telecortex.ser import DEFAULT_CID_CACHE, SERVERS_DOME, SERVERS_SINGLE
 from telecortex.session import TelecortexSession, VirtualTelecortexSession
 
 
@@ -35,9 +37,21 @@ class TeleCortexConfig(object):
                                  const=0, dest='verbose')
         self.parser.add_argument('--enable-log-file', default=False)
         self.parser.add_argument('--max-ack-queue', default=5, type=int)
+        self.parser.add_argument(
+            '--max-credit', default=32, type=int,
+            help=(
+                "most commands to leave unacknowledged, however much space "
+                "the controller reports in its command queue"))
+        self.parser.add_argument('--max-bytes-in-flight', default=None,
+                                 type=int)
         self.parser.add_argument('--do-crc', default=True)
         self.parser.add_argument('--skip-crc', action='store_false',
                                  dest='do_crc')
+        self.parser.add_argument('--coalesce-writes', default=True)
+        self.parser.add_argument('--no-coalesce-writes', action='store_false',
+                                 dest='coalesce_writes')
+        self.parser.add_argument('--io-thread', action='store_true',
+                                 default=False)
         self.parser.add_argument('--virtual', action='store_true')
         self.parser.add_argument('--ignore-acks', action='store_true',
                                  default=False)
@@ -142,11 +156,15 @@ class TeleCortexConfig(object):
     def session_kwargs(self):
         return {
             'max_ack_queue': self.args.max_ack_queue,
+            'max_credit': self.args.max_credit,
+            'max_bytes_in_flight': self.args.max_bytes_in_flight,
             'do_crc': self.args.do_crc,
             'ignore_acks': self.args.ignore_acks,
             'chunk_size': self.args.chunk_size,
             'ser_buf_size': self.args.ser_buf_size,
-            'sesh_relinquish': self.args.sesh_relinquish
+            'sesh_relinquish': self.args.sesh_relinquish,
+            'coalesce_writes': self.args.coalesce_writes,
+            'io_thread': self.args.io_thread
         }
 
 
@@ -178,24 +196,53 @@ class TeleCortexManagerConfig(TeleCortexConfig):
         super().__init__(*args, **kwargs)
         self.parser.add_argument('--manager-relinquish', default=0.001,
                                  type=float)
+        self.parser.add_argument(
+            '--mailbox', default=False, action='store_true',
+            help=(
+                "only hold the newest complete frame for each controller, "
+                "dropping stale frames"))
+        self.parser.add_argument(
+            '--cid-cache', default=DEFAULT_CID_CACHE,
+            help="file to remember the CID of each controller in")
+        self.parser.add_argument(
+            '--no-cid-cache', action='store_const', const=None,
+            dest='cid_cache')
 
     @property
     def manager_class(self):
         return self.virtual_manager_class if self.args.virtual \
             else self.real_manager_class
 
-    def setup_manager(self):
-        return self.manager_class(self.servers, **self.manager_kwargs)
+    def setup_manager(self, **kwargs):
+        return self.manager_class(
+            self.servers, **dict(self.manager_kwargs, **kwargs))
 
     @property
     def manager_kwargs(self):
         return dict(self.session_kwargs, **{
-            'manager_relinquish': self.args.manager_relinquish
+            'manager_relinquish': self.args.manager_relinquish,
+            'mailbox': self.args.mailbox,
+            'cid_cache': self.args.cid_cache,
         })
 
 class TeleCortexThreadManagerConfig(TeleCortexManagerConfig):
     real_manager_class = TelecortexThreadManager
     virtual_manager_class = TeleCortexVirtualThreadManager
+    real_thread_pool_manager_class = TelecortexThreadPoolManager
+    virtual_thread_pool_manager_class = TeleCortexVirtualThreadPoolManager
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parser.add_argument(
+            '--thread-pool', default=False, action='store_true',
+            help="drive controllers from threads instead of processes")
+
+    @property
+    def manager_class(self):
+        if not self.args.thread_pool:
+            return super().manager_class
+        return self.virtual_thread_pool_manager_class if self.args.virtual \
+            else self.real_thread_pool_manager_class
 
 
 class TeleCortexAsyncManagerConfig(TeleCortexManagerConfig):
@@ -207,6 +254,20 @@ class TeleCortexAsyncManagerConfig(TeleCortexManagerConfig):
     def __init__(self, graphics, *args, **kwargs):
         self.graphics = graphics
         super().__init__(*args, **kwargs)
+        self.parser.add_argument(
+            '--frame-executor', default='thread',
+            choices=['thread', 'process'],
+            help="kind of executor which frames are produced in")
+        self.parser.add_argument(
+            '--frames-in-flight', default=2, type=int,
+            help="maximum number of frames produced ahead of the current one")
+
+    @property
+    def manager_kwargs(self):
+        return dict(super().manager_kwargs, **{
+            'frame_executor': self.args.frame_executor,
+            'frames_in_flight': self.args.frames_in_flight,
+        })
 
     def setup_manager(self):
         return self.manager_class(
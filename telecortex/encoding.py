@@ -0,0 +1,157 @@
+"""
+Encode Telecortex commands as the bytes which are written to the controller.
+"""
+
+from __future__ import unicode_literals
+
+import numpy as np
+import six
+
+
+# Below this length, a python loop is faster than a numpy reduction
+SHORT_CHECKSUM_LEN = 32
+
+
+def xor_checksum(data):
+    """XOR all of the bytes in a bytes-like object together."""
+    if len(data) < SHORT_CHECKSUM_LEN:
+        checksum = 0
+        for byte in bytes(data):
+            checksum ^= byte
+        return checksum
+    return int(np.bitwise_xor.reduce(np.frombuffer(data, dtype=np.uint8)))
+
+
+def xor_prefix(data):
+    """
+    Cumulative XOR of a bytes-like object, with a leading zero.
+
+    The checksum of `data[start:end]` is `prefix[start] ^ prefix[end]`, so
+    once this is calculated, a slice of any length can be checksummed in
+    constant time.
+    """
+    prefix = np.zeros(len(data) + 1, dtype=np.uint8)
+    if len(data):
+        np.bitwise_xor.accumulate(
+            np.frombuffer(data, dtype=np.uint8), out=prefix[1:])
+    return prefix
+
+
+def to_wire_bytes(value):
+    """Convert a command argument or payload to bytes."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    return six.text_type(value).encode('ascii')
+
+
+def plan_payload_chunks(payload_len, chunk_pixels):
+    """
+    Determine where an encoded panel payload should be split into chunks.
+
+    `chunk_pixels` is a callable which is given the pixel offset of the next
+    chunk and returns the maximum number of pixels which fit in that chunk.
+
+    Return a tuple of (offset, start, end) for each chunk, where offset is the
+    pixel offset of the chunk and start, end are byte positions in the
+    payload. Each pixel takes 4 bytes because the payload is base64 encoded
+    24bit RGB.
+    """
+    plan = []
+    start = 0
+    while start < payload_len:
+        offset = start // 4
+        end = min(start + chunk_pixels(offset) * 4, payload_len)
+        plan.append((offset, start, end))
+        start = end
+    return tuple(plan)
+
+
+class TelecortexEncoder(object):
+    """
+    Encode commands straight to ready-to-write bytes.
+
+    Everything after the line number of a command (the header, e.g.
+    `M2600 Q0 S76 V`) is cached along with its checksum, so for each command
+    only the line number prefix and the payload have to be checksummed.
+
+    The encoded form is identical to `TelecortexCommand.fmt` followed by
+    `TelecortexSession.write_line`, e.g. `N5 M2600 Q0 S76 V<payload> *123\n`
+    """
+
+    # Headers are cleared when the cache grows past this size
+    max_cached_headers = 1024
+
+    def __init__(self, do_crc=True):
+        # Determines if the checksum is appended to commands
+        self.do_crc = do_crc
+        # Map of (cmd, static args, has payload) to (header, header checksum)
+        self.header_cache = {}
+
+    def get_header(self, cmd, args=None):
+        """
+        Get the encoded header bytes and their checksum.
+
+        If args contains a `V` key, its value is the payload, and the header
+        ends with `V` so that the payload can be appended directly.
+        """
+        if args:
+            has_payload = 'V' in args
+            static_args = tuple(
+                (key, value) for key, value in args.items() if key != 'V'
+            )
+        else:
+            has_payload = False
+            static_args = ()
+        key = (cmd, static_args, has_payload)
+        cached = self.header_cache.get(key)
+        if cached is not None:
+            return cached
+
+        header = " ".join(
+            [cmd] + ["%s%s" % (arg, value) for arg, value in static_args]
+        )
+        if has_payload:
+            header += " V"
+        header = header.encode('ascii')
+        if len(self.header_cache) >= self.max_cached_headers:
+            self.header_cache.clear()
+        cached = self.header_cache[key] = (header, xor_checksum(header))
+        return cached
+
+    def encode_parts(self, linenum, header, header_checksum, payload=b'',
+                     payload_checksum=None):
+        """
+        Encode a command given an already encoded header and its checksum.
+
+        `payload_checksum` can be provided if it is already known, e.g. from
+        `xor_prefix`.
+        """
+        parts = [header, payload]
+        if linenum is not None:
+            prefix = b"N%d " % linenum
+            parts.insert(0, prefix)
+        if self.do_crc:
+            if payload_checksum is None:
+                payload_checksum = xor_checksum(payload)
+            checksum = header_checksum ^ int(payload_checksum)
+            if linenum is not None:
+                checksum ^= xor_checksum(prefix)
+            last = payload[-1:] if len(payload) else header[-1:]
+            if bytes(last) != b' ':
+                parts.append(b' ')
+                checksum ^= 0x20
+            parts.append(b"*%d\n" % checksum)
+        else:
+            parts.append(b"\n")
+        return b"".join(parts)
+
+    def encode(self, cmd, args=None, linenum=None, payload_checksum=None):
+        """
+        Encode a command with optional arguments and line number as bytes.
+        """
+        payload = b''
+        if args and len(args.get('V') or b''):
+            payload = to_wire_bytes(args['V'])
+        header, header_checksum = self.get_header(cmd, args)
+        return self.encode_parts(
+            linenum, header, header_checksum, payload, payload_checksum)
@@ -21,7 +21,13 @@ DOT_RADIUS = 3
 
 start_time = time_now()
 
-def get_frameno():
+def get_frameno(seq=None):
+    """
+    Get the angle to animate by, from the time since start, or from `seq`,
+    the number of the frame being rendered, if it is given.
+    """
+    if seq is not None:
+        return (seq * ANIM_SPEED) % MAX_ANGLE
     return int(
         (time_now() - start_time) * TARGET_FRAMERATE * ANIM_SPEED
     ) % MAX_ANGLE
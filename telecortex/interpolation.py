@@ -85,6 +85,82 @@ def denormalize_coordinate(shape, coordinate):
             np.clip(min_dimension * coordinate[1], 0, shape[1] - 1)
         ])
 
+def denormalize_coordinates(shape, coordinates):
+    """
+    Vectorised `denormalize_coordinate` for an (N, 2) array of coordinates.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    min_dimension = min(shape[0], shape[1])
+    max_dimension = max(shape[0], shape[1])
+    delta_dimension = max_dimension - min_dimension
+    offset = (0, delta_dimension / 2) if shape[1] > shape[0] \
+        else (delta_dimension / 2, 0)
+    return np.stack([
+        np.clip(
+            min_dimension * coordinates[:, axis] + offset[axis],
+            0, shape[axis] - 1
+        )
+        for axis in (0, 1)
+    ], axis=1)
+
+
+class TelecortexNearestSampler(object):
+    """
+    Sample the pixels of a pixel map from images of a given shape using the
+    nearest image pixel.
+
+    The position of each channel of each pixel within the flattened image is
+    calculated once, so sampling a frame is a single `take`.
+    """
+
+    def __init__(self, pix_map_normalized, shape):
+        self.shape = tuple(shape)
+        channels = self.shape[2] if len(self.shape) > 2 else 1
+        coordinates = np.rint(
+            denormalize_coordinates(self.shape, pix_map_normalized)
+        ).astype(np.int32)
+        flat_indices = coordinates[:, 0] * self.shape[1] + coordinates[:, 1]
+        # Only the first 3 channels are used, e.g. of BGRA images
+        self.indices = (
+            flat_indices[:, np.newaxis] * channels
+            + np.arange(min(channels, 3), dtype=np.int32)
+        ).astype(np.int32)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def sample(self, image):
+        """
+        Get the (N, 3) uint8 array of the colour of each pixel in the map.
+        """
+        assert image.shape == self.shape, \
+            "image shape %s does not match sampler shape %s" % (
+                image.shape, self.shape)
+        return np.take(image.reshape(-1), self.indices)
+
+
+# Samplers are cleared when the cache grows past this size
+MAX_CACHED_SAMPLERS = 256
+# Map of (id of pixel map, image shape) to (pixel map, sampler). The pixel map
+# is kept so that its id can't be reused while it is in the cache.
+NEAREST_SAMPLERS = {}
+
+
+def get_nearest_sampler(pix_map_normalized, shape):
+    """
+    Get a cached TelecortexNearestSampler for a pixel map and image shape.
+    """
+    key = (id(pix_map_normalized), tuple(shape))
+    cached = NEAREST_SAMPLERS.get(key)
+    if cached is not None:
+        return cached[1]
+    if len(NEAREST_SAMPLERS) >= MAX_CACHED_SAMPLERS:
+        NEAREST_SAMPLERS.clear()
+    sampler = TelecortexNearestSampler(pix_map_normalized, shape)
+    NEAREST_SAMPLERS[key] = (pix_map_normalized, sampler)
+    return sampler
+
+
 def interpolate_pixel_map(image, pix_map_normalized, interp_type=None):
     """
     Generate a pixel list from an image and a pixel map.
@@ -100,38 +176,26 @@ def interpolate_pixel_map(image, pix_map_normalized, interp_type=None):
     `itertools.chain` takes a list of lists, and basically flattens that list
     https://docs.python.org/2/library/itertools.html#itertools.chain .
 
-    This could be optimized by calculating the denormalized coordinates first.
+    Nearest interpolation uses a cached TelecortexNearestSampler, which
+    should be used directly if a numpy array is more useful than a list.
     """
+    if interp_type == 'nearest':
+        return get_nearest_sampler(
+            pix_map_normalized, image.shape
+        ).sample(image).reshape(-1).tolist()
+
     pix_coordinates = [
         denormalize_coordinate(image.shape, pix)
         for pix in pix_map_normalized
     ]
 
     pixel_list = []
-    if interp_type == 'nearest':
-        # Here be bad numpy hacks
-        pix_coordinates = list(map(
-            lambda x: int(round(x[0])) * image.shape[0] + int(round(x[0])),
-            pix_coordinates
-        ))
-        pixel_list_raw = image.reshape(
-            image.shape[0] * image.shape[1],
-            image.shape[2]
-        )[pix_coordinates]
-
-        # Fix when image type is BRGA
-        pixel_list = []
-        for pixel_value in pixel_list_raw:
-            if len(pixel_value) > 3:
-                pixel_value = tuple(pixel_value[:3])
-            pixel_list.append(pixel_value)
-    else:
-        for pix_coordinate in pix_coordinates:
-            pixel_value = interpolate_pixel(image, pix_coordinate, interp_type)
-            if len(pixel_value) > 3:
-                # BGRA fix
-                pixel_value = tuple(pixel_value[:3])
-            pixel_list.append(pixel_value)
+    for pix_coordinate in pix_coordinates:
+        pixel_value = interpolate_pixel(image, pix_coordinate, interp_type)
+        if len(pixel_value) > 3:
+            # BGRA fix
+            pixel_value = tuple(pixel_value[:3])
+        pixel_list.append(pixel_value)
 
     # logging.debug("pixel_list: %s" % pformat(pixel_list))
     pixel_list = list(itertools.chain(*pixel_list))
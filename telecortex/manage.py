@@ -5,6 +5,7 @@ TODO: Managers have access to conf object.
 """
 
 
+import base64
 import logging
 import multiprocessing as mp
 import queue
@@ -13,16 +14,42 @@ import serial_asyncio
 import functools
 import itertools
 import sys
+import threading
 import time
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 import serial
 
 from context import telecortex
-from telecortex.ser import DEFAULT_BAUD, DEFAULT_TIMEOUT, IGNORE_SERIAL_NO, IGNORE_VID_PID, query_serial_dev
-from telecortex.session import (TelecortexSerialProtocol, TelecortexSession,
+from telecortex.canvas import TelecortexSharedCanvas
+from telecortex.interpolation import (get_nearest_sampler,
+                                      interpolate_pixel_map)
+from telecortex.recording import TelecortexRecorder
+from serial.tools import list_ports
+from telecortex.ser import DEFAULT_BAUD, DEFAULT_TIMEOUT, IGNORE_SERIAL_NO, IGNORE_VID_PID, TelecortexCidCache, query_serial_dev
+from telecortex.session import (COMMIT_FRAME, MAILBOX_FRAME,
+                                TelecortexCommitBarrier,
+                                TelecortexSerialProtocol, TelecortexSession,
                                 ThreadedTelecortexSession,
                                 VirtualTelecortexSession)
+from telecortex.util import pix_array2text
+
+# Queued in place of a command to sample a frame from the shared canvas
+CANVAS_FRAME = 'CANVAS'
+
+# Arguments of the frame producer, given to each executor worker once
+producer_args = ()
+
+
+def set_producer_args(args):
+    global producer_args
+    producer_args = args
+
+
+def run_producer(producer, seq):
+    return producer(seq, *producer_args)
 
 
 # TODO: rename TelecortexBaseManager
@@ -32,13 +59,29 @@ class TeleCortexBaseManager(object):
     """
     session_class = TelecortexSession
     serial_class = serial.Serial
+    # Number of frames to keep the commit skew of
+    max_commit_skews = 100
+    # Seconds to wait for the CID of each port when discovering devices
+    probe_timeout = 5
 
     def __init__(self, servers, **kwargs):
         self.queue_len = kwargs.pop('queue_len', 10)
         self.servers = servers
         self.known_cids = OrderedDict()
         self.__class__.manager_relinquish = kwargs.pop('manager_relinquish', 0.001)
+        # Determines if each controller only holds the newest complete frame,
+        # dropping stale frames instead of queueing them.
+        self.mailbox = kwargs.pop('mailbox', False)
+        # File which the CID of each port is remembered in between runs
+        cid_cache = kwargs.pop('cid_cache', None)
+        self.cid_cache = TelecortexCidCache(cid_cache) if cid_cache else None
         self.session_kwargs = kwargs
+        # Time between the first and last controller committing each frame
+        self.commit_skews = deque(maxlen=self.max_commit_skews)
+        # Commands of the frame being built for each server in mailbox mode
+        self.pending_frames = OrderedDict()
+        # Number of stale frames dropped for each server in mailbox mode
+        self.frame_drops = OrderedDict()
 
     @classmethod
     def open_sesh(cls, serial_kwargs, session_kwargs):
@@ -56,62 +99,181 @@ class TeleCortexBaseManager(object):
         May have to make connections to devices in order to determine CID if
         device file is not given.
         """
-        response = {
-            'baudrate': server_info.get('baud', DEFAULT_BAUD),
-            'timeout': server_info.get('timeout', DEFAULT_TIMEOUT)
-        }
-        if 'file' in server_info:
-            response['port'] = server_info['file']
-            return response
+        return self.get_serial_confs(
+            OrderedDict([(None, server_info)]))[None]
+
+    def get_serial_confs(self, servers):
+        """
+        Determine the arguments to give to serial.Serial for each server in
+        an OrderedDict of server_id to server_info.
 
-        dev_kwargs = {}
-        for key in ['vid', 'pid', 'ser', 'dev']:
-            if IGNORE_SERIAL_NO and key in ['ser']:
+        Serial ports are only enumerated once, and the CID of every candidate
+        port which is not already known is probed at the same time, so
+        discovering several controllers takes about as long as one. Each port
+        is only given to the first server which matches it.
+        """
+        port_infos = list_ports.comports()
+        responses = OrderedDict()
+        candidates = OrderedDict()
+        probe_confs = OrderedDict()
+        for server_id, server_info in servers.items():
+            response = {
+                'baudrate': server_info.get('baud', DEFAULT_BAUD),
+                'timeout': server_info.get('timeout', DEFAULT_TIMEOUT)
+            }
+            responses[server_id] = response
+            if 'file' in server_info:
+                response['port'] = server_info['file']
                 continue
-            if IGNORE_VID_PID and key in ['vid', 'pid']:
+
+            dev_kwargs = {}
+            for key in ['vid', 'pid', 'ser', 'dev']:
+                if IGNORE_SERIAL_NO and key in ['ser']:
+                    continue
+                if IGNORE_VID_PID and key in ['vid', 'pid']:
+                    continue
+                if key in server_info:
+                    dev_kwargs[key] = server_info[key]
+
+            ports = query_serial_dev(port_infos=port_infos, **dev_kwargs)
+            candidates[server_id] = ports
+
+            if server_info.get('cid') is not None:
+                for port in ports:
+                    if port not in self.known_cids \
+                            and port not in probe_confs:
+                        probe_confs[port] = dict(response, port=port)
+
+        self.known_cids.update(self.discover_cids(probe_confs, port_infos))
+
+        used_ports = set()
+        for server_id, ports in candidates.items():
+            server_info = servers[server_id]
+            if server_info.get('cid') is not None:
+                ports = [
+                    port for port in ports
+                    if self.known_cids.get(port) == server_info.get('cid')
+                ]
+            ports = [port for port in ports if port not in used_ports]
+
+            if len(ports) > 1:
+                logging.warning(
+                    "ambiguous server info matches multiple ports: %s | %s" % (
+                        server_info, ports
+                    )
+                )
+
+            if not ports:
+                logging.critical(
+                    "target device not found for server: %s" % server_info)
+                responses[server_id] = {}
                 continue
-            if key in server_info:
-                dev_kwargs[key] = server_info[key]
+            responses[server_id]['port'] = ports[0]
+            used_ports.add(ports[0])
 
-        ports = query_serial_dev(**dev_kwargs)
+        return responses
 
-        if 'cid' in server_info:
-            ports_matching_cid = []
+    def discover_cids(self, probe_confs, port_infos):
+        """
+        Determine the CIDs of several ports, given an OrderedDict of port to
+        serial.Serial arguments.
 
-            for port in ports:
-                cid = None
-                if port in self.known_cids:
-                    cid = self.known_cids[port]
-                    if cid != server_info.get('cid'):
-                        continue
-                else:
-                    serial_kwargs = response.copy()
-                    serial_kwargs['port'] = port
-                    sesh = self.open_sesh(serial_kwargs, self.session_kwargs)
-                    sesh.reset_board()
-                    if server_info.get('cid') is not None:
-                        sesh_cid = int(sesh.get_cid())
-                        self.known_cids[port] = sesh_cid
-                        if sesh_cid != server_info.get('cid'):
-                            sesh.close()
-                            continue
-                ports_matching_cid.append(port)
-            ports = ports_matching_cid
-
-        if len(ports) > 1:
-            logging.warning(
-                "ambiguous server info matches multiple ports: %s | %s" % (
-                    server_info, ports
-                )
-            )
+        Ports with a CID in `cid_cache` are only asked for their CID, which is
+        much quicker than resetting them. Only ports which are not cached, or
+        which don't give the cached CID, are reset and probed.
+        """
+        if self.cid_cache is None or not probe_confs:
+            return self.probe_cids(probe_confs)
+        port_infos = dict([
+            (port_info.device, port_info) for port_info in port_infos
+        ])
+        cached_cids = dict([
+            (port, self.cid_cache.get_cid(port_infos[port]))
+            for port in probe_confs.keys()
+        ])
+        cids = self.probe_cids(OrderedDict([
+            (port, serial_kwargs)
+            for port, serial_kwargs in probe_confs.items()
+            if cached_cids[port] is not None
+        ]), reset=False)
+        for port, cid in list(cids.items()):
+            if cid != cached_cids[port]:
+                logging.warning(
+                    "cached CID of %s is %s, not %s" % (
+                        port, cached_cids[port], cid))
+                del cids[port]
+        cids.update(self.probe_cids(OrderedDict([
+            (port, serial_kwargs)
+            for port, serial_kwargs in probe_confs.items()
+            if port not in cids
+        ])))
+        for port, cid in cids.items():
+            self.cid_cache.set_cid(port_infos[port], cid)
+        self.cid_cache.save()
+        return cids
 
-        if not ports:
-            logging.critical(
-                "target device not found for server: %s" % server_info)
-            return {}
-        response['port'] = ports[0]
+    @classmethod
+    def probe_cid(cls, serial_kwargs, session_kwargs, cids, reset=True,
+                  timeout=None):
+        """
+        Open a session on a port and store its CID in `cids`.
 
-        return response
+        If `reset` is False, the controller is only told the line number to
+        expect, instead of being reset. The probe gives up once `timeout`
+        seconds have passed without a response, so a silent port is closed.
+        """
+        port = serial_kwargs.get('port')
+        sesh = None
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            sesh = cls.open_sesh(serial_kwargs, session_kwargs)
+            if reset:
+                sesh.reset_board(timeout)
+            else:
+                sesh.set_linenum(0, timeout)
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            cids[port] = int(sesh.get_cid(timeout))
+        except Exception as exc:
+            logging.error("could not probe CID of %s: %s" % (port, exc))
+        finally:
+            if sesh is not None:
+                sesh.close()
+
+    def probe_cids(self, probe_confs, reset=True):
+        """
+        Probe the CIDs of several ports at once, given an OrderedDict of port
+        to serial.Serial arguments.
+
+        Return a dict of port to CID for the ports which responded within
+        `probe_timeout`. Every probe has finished and closed its port by the
+        time this returns.
+        """
+        cids = {}
+        threads = []
+        for port, serial_kwargs in probe_confs.items():
+            thread = threading.Thread(
+                target=self.probe_cid,
+                args=(
+                    serial_kwargs, self.session_kwargs, cids, reset,
+                    self.probe_timeout
+                ),
+                name="probe_%s" % port
+            )
+            # Don't let a port which never responds prevent exiting
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # Probes check their deadline between reads, which block for up
+            # to the serial timeout.
+            thread.join()
+        for port in probe_confs.keys():
+            if port not in cids:
+                logging.warning("no CID from %s" % port)
+        return dict(cids)
 
     @classmethod
     def relinquish(cls):
@@ -127,6 +289,31 @@ class TeleCortexBaseManager(object):
     def chunk_payload_with_linenum(self, server_id, cmd, args, payload):
         raise NotImplementedError()
 
+    def record_commit_skew(self, commit_times):
+        """
+        Record the skew of a frame, given the time each controller committed.
+        """
+        if not commit_times:
+            return None
+        skew = max(commit_times.values()) - min(commit_times.values())
+        self.commit_skews.append(skew)
+        logging.debug("frame commit skew: %.6fs" % skew)
+        return skew
+
+    @property
+    def last_commit_skew(self):
+        if self.commit_skews:
+            return self.commit_skews[-1]
+
+    def drop_frame(self, server_id, commands):
+        """
+        Count a stale frame which was superseded before it was sent.
+        """
+        self.frame_drops[server_id] = self.frame_drops.get(server_id, 0) + 1
+        logging.info(
+            "server %s dropped a stale frame, %d dropped" % (
+                server_id, self.frame_drops[server_id]))
+
 # TODO: rename TelecortexSyncManager, as in opposite of async
 class TelecortexSessionManager(TeleCortexBaseManager):
     """
@@ -141,6 +328,7 @@ class TelecortexSessionManager(TeleCortexBaseManager):
         """
         Use information from `self.servers`, ensure all sessions are connected.
         """
+        missing = OrderedDict()
         for server_id, server_info in self.servers.items():
             logging.info(
                 "looking for server_id %d with info: %s" %
@@ -158,9 +346,12 @@ class TelecortexSessionManager(TeleCortexBaseManager):
             if self.sessions.get(server_id) is not None:
                 continue
 
-            # if session does not exist, create a new one
-            serial_conf = self.get_serial_conf(server_info)
+            missing[server_id] = server_info
 
+        # if session does not exist, create a new one
+        serial_confs = self.get_serial_confs(missing)
+        for server_id, server_info in missing.items():
+            serial_conf = serial_confs[server_id]
             if serial_conf:
                 sesh = self.open_sesh(serial_conf, self.session_kwargs)
                 sesh.reset_board()
@@ -181,8 +372,31 @@ class TelecortexSessionManager(TeleCortexBaseManager):
         return True
 
     def wait_for_workers_idle(self):
-        # TODO: implement this
-        pass
+        for session in self.sessions.values():
+            session.wait_idle()
+
+    def commit_frame(self, server_ids=None):
+        """
+        Write everything buffered for each controller, then send M2610 to all
+        of them back to back. Return the commit skew.
+        """
+        if server_ids is None:
+            server_ids = list(self.sessions.keys())
+        for server_id in server_ids:
+            session = self.sessions[server_id]
+            session.wait_idle()
+            if session.io_thread is None:
+                session.flush_out()
+        for server_id in server_ids:
+            self.sessions[server_id].commit_frame()
+        # In I/O thread mode, the commits are written by the I/O threads, so
+        # their times are only known once they are done
+        commit_times = OrderedDict()
+        for server_id in server_ids:
+            session = self.sessions[server_id]
+            session.wait_idle()
+            commit_times[server_id] = session.last_commit_time
+        return self.record_commit_skew(commit_times)
 
     def __enter__(self, *args, **kwargs):
         # TODO: this
@@ -206,6 +420,12 @@ class TelecortexVirtualManagerMixin(object):
             'timeout': server_info.get('timeout', DEFAULT_TIMEOUT)
         }
 
+    def get_serial_confs(self, servers):
+        return OrderedDict([
+            (server_id, self.get_serial_conf(server_info))
+            for server_id, server_info in servers.items()
+        ])
+
 
 class TelecortexVirtualManager(
     TelecortexSessionManager, TelecortexVirtualManagerMixin
@@ -213,70 +433,486 @@ class TelecortexVirtualManager(
     serial_class = TelecortexVirtualManagerMixin.serial_class
     session_class = TelecortexVirtualManagerMixin.session_class
     get_serial_conf = TelecortexVirtualManagerMixin.get_serial_conf
+    get_serial_confs = TelecortexVirtualManagerMixin.get_serial_confs
+
+
+class TelecortexThreadContext(object):
+    """
+    Stands in for a `multiprocessing` context, so that controller workers are
+    threads in this process, and commands are passed through their queues by
+    reference instead of being pickled.
+    """
+    Queue = queue.Queue
+    Semaphore = threading.Semaphore
+    Condition = threading.Condition
+
+    @classmethod
+    def Process(cls, target, args, name):
+        return threading.Thread(
+            target=target, args=args, name=name, daemon=True)
+
+    @classmethod
+    def Array(cls, typecode, size_or_initializer, lock=False):
+        if isinstance(size_or_initializer, int):
+            return [0] * size_or_initializer
+        return list(size_or_initializer)
+
+
+class TelecortexFrameBarrier(object):
+    """
+    Hold back the frame commit of each controller process until every
+    controller process committing the same frame is ready.
+
+    Unlike a `multiprocessing.Barrier`, the number of parties is given with
+    each frame, so it follows controller processes being started and
+    stopped without the barrier having to be handed to them again. A party
+    which times out, or arrives after the next frame has started, carries
+    on without waiting, and the barrier never has to be reset.
+    """
+
+    def __init__(self, ctx):
+        self.cond = ctx.Condition()
+        # Sequence number of the frame being waited for, the number of
+        # parties which have arrived for it, and the sequence number of the
+        # last frame which every party arrived for
+        self.state = ctx.Array('q', [-1, 0, -1], lock=False)
+
+    def wait(self, seq, parties, timeout=None):
+        """
+        Wait until `parties` controller processes have arrived for frame
+        `seq`. Return False if they did not arrive in time.
+        """
+        with self.cond:
+            if self.state[0] > seq:
+                return False
+            if self.state[0] < seq:
+                # The first party to arrive for a frame releases any parties
+                # still waiting for an earlier one
+                self.state[0] = seq
+                self.state[1] = 0
+                self.cond.notify_all()
+            self.state[1] += 1
+            if self.state[1] >= parties:
+                self.state[2] = seq
+                self.cond.notify_all()
+                return True
+            self.cond.wait_for(
+                lambda: self.state[0] != seq or self.state[2] >= seq,
+                timeout
+            )
+            return self.state[2] >= seq
 
 
 class TelecortexThreadManager(TeleCortexBaseManager):
     """
-    Manage TelecortexSession objects in multiple sessions.
+    Manage TelecortexSession objects in multiple processes.
     """
     session_class = ThreadedTelecortexSession
+    # Clock which controller workers measure their CPU use with
+    cpu_clock = staticmethod(time.process_time)
+    # Time a controller process blocks waiting for a command before it
+    # handles any responses from its controller.
+    worker_timeout = 0.1
+    # Interval between each controller process logging its counters
+    stats_interval = 10.0
+    # Time to block putting a command on a full queue before giving up
+    put_timeout = 5.0
 
     def __init__(self, servers, **kwargs):
+        # Shape of the shared canvas. If given, the parent renders into
+        # `get_canvas()` and each controller process samples its own panels.
+        self.canvas_shape = kwargs.pop('canvas_shape', None)
+        # Map of server_id to a list of (panel_number, pixel map) which that
+        # controller samples from the shared canvas
+        self.canvas_panels = kwargs.pop('canvas_panels', None) or {}
+        # Interpolation type used to sample the shared canvas
+        self.canvas_interp_type = kwargs.pop('canvas_interp_type', 'nearest')
+        # Time to wait for a controller to sample a frame before giving up
+        self.canvas_timeout = kwargs.pop('canvas_timeout', 1.0)
+        # Time to wait on the commit barrier before giving up
+        self.commit_timeout = kwargs.pop('commit_timeout', 1.0)
         super(TelecortexThreadManager, self).__init__(servers, **kwargs)
+        self.canvas = None
+        if self.canvas_shape is not None:
+            self.canvas = TelecortexSharedCanvas(self.canvas_shape)
+        # Sequence number of the last frame committed to the canvas
+        self.canvas_seq = -1
+        # Sequence numbers of frames which may still be being sampled
+        self.canvas_unsampled = deque()
+        # A semaphore for each server_id, released when a frame is sampled
+        self.canvas_sampled = OrderedDict()
+        # Sequence number of the last frame of each server_id which the
+        # parent dropped from its mailbox
+        self.canvas_dropped_seqs = OrderedDict()
+        # Index of each server_id in commit_times, commit_seqs and
+        # canvas_sampled_seqs
+        self.commit_index = OrderedDict(
+            (server_id, index) for index, server_id in enumerate(servers))
+        ctx = self.get_context()
+        # Sequence number of the last frame each controller process has
+        # finished with, whether it was sampled or dropped
+        self.canvas_sampled_seqs = ctx.Array(
+            'q', [-1] * len(servers), lock=False)
+        # Barrier which every controller process waits on before committing
+        self.commit_barrier = TelecortexFrameBarrier(ctx)
+        # Time at which each controller process last committed a frame
+        self.commit_times = ctx.Array('d', len(servers), lock=False)
+        # Sequence number of the frame each controller process last committed
+        self.commit_seqs = ctx.Array('q', [-1] * len(servers), lock=False)
+        # Sequence number of the last frame committed, and of the last frame
+        # which the skew was recorded for
+        self.commit_seq = -1
+        # server_ids of the controller processes committing the last frame
+        self.commit_parties = []
+        self.skew_seq = -1
+        # A semaphore for each server_id, released by the controller process
+        # each time it finishes with an item from its queue
+        self.cmds_done = OrderedDict()
+        # Number of items put on each queue, and number known to be finished
+        self.cmds_put = OrderedDict()
+        self.cmds_finished = OrderedDict()
         # A tuple of (queue, proc) for each server_id
         # TODO: split into sesh_workers and cmd_queues
         self.sessions = OrderedDict()
         self.refresh_connections()
 
     @classmethod
-    def controller_thread(cls, serial_conf, queue_, session_kwargs):
+    def controller_thread(cls, serial_conf, queue_, session_kwargs,
+                          canvas_conf=None, commit_conf=None, done=None):
         # setup serial device
 
         sesh = cls.open_sesh(serial_conf, session_kwargs)
         sesh.reset_board()
         sesh.get_cid()
-        # listen for commands
-        while sesh:
-            try:
-                cmd, args, payload = queue_.get_nowait()
-            except queue.Empty as exc:
-                logging.info("Queue Empty: %s | %s" % (sesh.cid, exc))
-                # TODO: relinquish control to other sessions
-                cls.relinquish()
-                continue
-            except Exception as exc:
-                logging.error(exc)
+        canvas = None
+        if canvas_conf is not None:
+            canvas = TelecortexSharedCanvas.attach(
+                canvas_conf['name'], canvas_conf['shape'])
+        # Counters which show how much work the process does while idle
+        stats = OrderedDict([('wakeups', 0), ('idle_wakeups', 0), ('cmds', 0)])
+        stats_start = time.time()
+        cpu_start = cls.cpu_clock()
+        # listen for commands, closing the canvas however this stops
+        try:
+            while sesh:
+                if time.time() - stats_start >= cls.stats_interval:
+                    cls.log_worker_stats(
+                        sesh, stats, time.time() - stats_start,
+                        cls.cpu_clock() - cpu_start)
+                    stats_start = time.time()
+                    cpu_start = cls.cpu_clock()
+                    for key in stats:
+                        stats[key] = 0
+                stats['wakeups'] += 1
+                try:
+                    item = queue_.get(timeout=cls.worker_timeout)
+                except queue.Empty:
+                    stats['idle_wakeups'] += 1
+                    # With an I/O thread, only that thread reads from the port
+                    if sesh.io_thread is None and sesh.lines_avail:
+                        sesh.parse_responses()
+                    continue
+                except Exception as exc:
+                    logging.error(exc)
+                    continue
+                if item is None:
+                    # Asked to stop
+                    sesh.close()
+                    break
+                cmd, args, payload = item
+                stats['cmds'] += 1
+                # logging.debug("received: %s" % str((cmd, args, payload)))
+                if cmd == MAILBOX_FRAME:
+                    commands = args
+                else:
+                    commands = [(cmd, args, payload)]
+                for cmd, args, payload in commands:
+                    if cmd == CANVAS_FRAME:
+                        cls.send_canvas_frame(sesh, canvas, canvas_conf, args)
+                    elif cmd == COMMIT_FRAME:
+                        cls.send_commit(sesh, commit_conf, *args)
+                    else:
+                        sesh.chunk_payload_with_linenum(cmd, args, payload)
+                    sesh.wait_ready()
+                if done is not None:
+                    done.release()
+        finally:
+            if canvas is not None:
+                canvas.close()
+
+    @classmethod
+    def log_worker_stats(cls, sesh, stats, elapsed, cpu):
+        logging.info(
+            "CID: %s %s, CPU: %.1f%%" % (
+                sesh.cid,
+                ", ".join([
+                    "%s: %.1f/s" % (key, value / elapsed)
+                    for key, value in stats.items()
+                ]),
+                100 * cpu / elapsed
+            )
+        )
+
+    @classmethod
+    def send_canvas_frame(cls, sesh, canvas, canvas_conf, seq):
+        """
+        Sample this controller's panels from frame `seq` of the shared canvas,
+        then encode and send them.
+        """
+        if canvas.get_seq(seq) != seq:
+            # The parent gave up waiting for this frame and rendered over it
+            logging.warning(
+                "CID: %s frame %d was overwritten before sampling, "
+                "dropping it" % (sesh.cid, seq))
+            cls.finish_canvas_frame(canvas_conf, seq)
+            return
+        image = canvas.get_buffer(seq)
+        pixel_lists = []
+        for panel_number, pix_map in canvas_conf['panels']:
+            if canvas_conf['interp_type'] == 'nearest':
+                pixel_lists.append((panel_number, get_nearest_sampler(
+                    pix_map, image.shape
+                ).sample(image)))
                 continue
-            # logging.debug("received: %s" % str((cmd, args, payload)))
-            sesh.chunk_payload_with_linenum(cmd, args, payload)
-            while not sesh.ready:
-                logging.debug("sesh not ready: %s" % sesh.cid)
-                # TODO: relinquish control here
-                cls.relinquish()
+            pixel_lists.append((panel_number, interpolate_pixel_map(
+                image, pix_map, canvas_conf['interp_type']
+            )))
+        overwritten = canvas.get_seq(seq) != seq
+        # The parent can render into this buffer again once it is sampled
+        cls.finish_canvas_frame(canvas_conf, seq)
+        if overwritten:
+            logging.warning(
+                "CID: %s frame %d was overwritten while sampling, "
+                "dropping it" % (sesh.cid, seq))
+            return
+        for panel_number, pixel_list in pixel_lists:
+            if isinstance(pixel_list, np.ndarray):
+                payload = base64.b64encode(pixel_list.tobytes())
+            else:
+                payload = pix_array2text(*pixel_list)
+            sesh.chunk_payload_with_linenum(
+                "M2600", {"Q": panel_number}, payload
+            )
+
+    @classmethod
+    def finish_canvas_frame(cls, canvas_conf, seq):
+        """
+        Tell the parent this controller process is finished with canvas
+        frame `seq`.
+        """
+        canvas_conf['seqs'][canvas_conf['index']] = seq
+        canvas_conf['sampled'].release()
+
+    @classmethod
+    def send_commit(cls, sesh, commit_conf, seq, parties):
+        """
+        Write everything sent so far, wait until the other `parties`
+        controller processes committing frame `seq` have done the same, then
+        send M2610 and record when it was written.
+        """
+        sesh.wait_idle()
+        if sesh.io_thread is None:
+            sesh.flush_out()
+        if not commit_conf['barrier'].wait(
+            seq, parties, commit_conf['timeout']
+        ):
+            logging.warning(
+                "CID: %s committing frame %d without the other controllers" % (
+                    sesh.cid, seq))
+        sesh.commit_frame()
+        sesh.wait_idle()
+        commit_conf['times'][commit_conf['index']] = sesh.last_commit_time
+        commit_conf['seqs'][commit_conf['index']] = seq
+
+    def get_canvas_conf(self, server_id):
+        """
+        Determine what a controller process needs to sample the shared canvas.
+        """
+        if self.canvas is None or not self.canvas_panels.get(server_id):
+            return None
+        return {
+            'name': self.canvas.name,
+            'shape': self.canvas.shape,
+            'panels': self.canvas_panels[server_id],
+            'interp_type': self.canvas_interp_type,
+            'sampled': self.canvas_sampled[server_id],
+            'seqs': self.canvas_sampled_seqs,
+            'index': self.commit_index[server_id],
+        }
+
+    def get_canvas(self):
+        """
+        Get the shared image to render the next frame into.
+
+        Blocks until every controller has finished sampling the frame which
+        was previously rendered into the same buffer.
+        """
+        seq = self.canvas_seq + 1
+        while self.canvas_unsampled and \
+                self.canvas_unsampled[0] <= seq - self.canvas.buffer_count:
+            frame_seq = self.canvas_unsampled.popleft()
+            for server_id in self.canvas_sampled.keys():
+                self.wait_for_sample(server_id, frame_seq)
+        return self.canvas.get_buffer(seq)
+
+    def wait_for_sample(self, server_id, frame_seq):
+        """
+        Block until a controller process has finished with canvas frame
+        `frame_seq`. Return False if it has not within canvas_timeout, in
+        which case the frame is dropped for that controller.
+
+        The semaphore only wakes the parent up. Whether the frame is finished
+        with is read from canvas_sampled_seqs, so a late release for a frame
+        which was given up on is not mistaken for a later frame.
+        """
+        index = self.commit_index[server_id]
+        sampled = self.canvas_sampled[server_id]
+        deadline = time.time() + self.canvas_timeout
+        while max(
+            self.canvas_sampled_seqs[index],
+            self.canvas_dropped_seqs.get(server_id, -1)
+        ) < frame_seq:
+            timeout = deadline - time.time()
+            if timeout <= 0 or not sampled.acquire(timeout=timeout):
+                logging.warning(
+                    "server %s did not sample frame %d in %ss, dropping it" % (
+                        server_id, frame_seq, self.canvas_timeout))
+                return False
+        return True
+
+    def commit_canvas(self):
+        """
+        Mark the frame rendered into `get_canvas()` as complete, and have each
+        controller sample, encode, send and commit it.
+        """
+        self.canvas_seq += 1
+        self.canvas.set_seq(self.canvas_seq)
+        self.canvas_unsampled.append(self.canvas_seq)
+        for server_id in self.canvas_sampled.keys():
+            self.chunk_payload_with_linenum(
+                server_id, CANVAS_FRAME, self.canvas_seq, None)
+        self.commit_frame()
+        return self.canvas_seq
+
+    def get_commit_conf(self, server_id):
+        """
+        Determine what a controller process needs to commit frames in sync.
+        """
+        return {
+            'barrier': self.commit_barrier,
+            'timeout': self.commit_timeout,
+            'times': self.commit_times,
+            'seqs': self.commit_seqs,
+            'index': self.commit_index[server_id],
+        }
+
+    def commit_frame(self):
+        """
+        Have every controller process commit a frame at the same time, once
+        it has sent everything queued before.
+
+        In mailbox mode, controllers are not held back by each other, so
+        each frame is completed with a plain M2610 and posted instead.
+        """
+        if self.mailbox:
+            for server_id in self.sessions.keys():
+                self.chunk_payload_with_linenum(
+                    server_id, "M2610", None, None)
+            self.post_frames()
+            return
+        self.update_commit_skew()
+        self.commit_seq += 1
+        # Only the controller processes which are alive take part
+        self.commit_parties = [
+            server_id for server_id, (queue_, proc) in self.sessions.items()
+            if proc.is_alive()
+        ]
+        for server_id in self.commit_parties:
+            self.chunk_payload_with_linenum(
+                server_id, COMMIT_FRAME,
+                (self.commit_seq, len(self.commit_parties)), None)
+        return self.commit_seq
+
+    def update_commit_skew(self):
+        """
+        Record the commit skew of the last frame once every controller
+        process has committed it.
+        """
+        if self.commit_seq < 0 or self.skew_seq == self.commit_seq:
+            return
+        commit_times = OrderedDict()
+        for server_id in self.commit_parties:
+            index = self.commit_index[server_id]
+            if self.commit_seqs[index] != self.commit_seq:
+                return
+            commit_times[server_id] = self.commit_times[index]
+        self.skew_seq = self.commit_seq
+        self.record_commit_skew(commit_times)
+
+    def get_context(self):
+        assert sys.version_info > (3, 0), (
+            "multiprocessing only works properly on python 3")
+        return mp.get_context('fork')
+
+    def stop_worker(self, server_id):
+        """
+        Ask a controller process to stop, so it can close its session and
+        canvas, and terminate it if it doesn't.
+        """
+        queue_, proc = self.sessions[server_id]
+        if proc.is_alive():
+            try:
+                queue_.put(None, timeout=self.worker_timeout)
+            except queue.Full:
+                pass
+            proc.join(self.worker_timeout)
+        if proc.is_alive():
+            proc.terminate()
+
+    def close(self):
+        for server_id in self.sessions.keys():
+            self.stop_worker(server_id)
+        self.sessions = OrderedDict()
+        if self.canvas is not None:
+            self.canvas.close()
+            self.canvas = None
 
     def refresh_connections(self, server_ids=None):
         if server_ids is None:
             server_ids = self.servers.keys()
 
-        assert sys.version_info > (3, 0), (
-            "multiprocessing only works properly on python 3")
-        ctx = mp.get_context('fork')
+        ctx = self.get_context()
 
         for server_id in server_ids:
-            queue, old_proc = self.sessions.get(server_id, (None, None))
-            if old_proc is not None:
-                old_proc.terminate()
+            if server_id in self.sessions:
+                self.stop_worker(server_id)
 
-            server_info = self.servers.get(server_id, {})
-            serial_conf = self.get_serial_conf(server_info)
+        serial_confs = self.get_serial_confs(OrderedDict([
+            (server_id, self.servers.get(server_id, {}))
+            for server_id in server_ids
+        ]))
 
+        for server_id, serial_conf in serial_confs.items():
+            queue, _ = self.sessions.get(server_id, (None, None))
             if serial_conf:
                 if queue is None:
-                    queue = mp.Queue(self.queue_len)
+                    queue = ctx.Queue(1 if self.mailbox else self.queue_len)
+                if self.canvas is not None \
+                        and self.canvas_panels.get(server_id) \
+                        and server_id not in self.canvas_sampled:
+                    self.canvas_sampled[server_id] = ctx.Semaphore(0)
+                self.cmds_done[server_id] = ctx.Semaphore(0)
+                self.cmds_put[server_id] = 0
+                self.cmds_finished[server_id] = 0
 
                 proc = ctx.Process(
                     target=self.controller_thread,
-                    args=(serial_conf, queue, self.session_kwargs),
+                    args=(
+                        serial_conf, queue, self.session_kwargs,
+                        self.get_canvas_conf(server_id),
+                        self.get_commit_conf(server_id),
+                        self.cmds_done[server_id]
+                    ),
                     name="controller_%s" % server_id
                 )
                 proc.start()
@@ -295,36 +931,94 @@ class TelecortexThreadManager(TeleCortexBaseManager):
         return all([queue.empty() for (queue, proc) in self.sessions.values()])
 
     def wait_for_workers_idle(self):
-        while not self.all_idle:
-            logging.debug("waiting on queue idle")
-            self.relinquish()
+        """
+        Block until every controller process has finished with everything
+        put on its queue.
+
+        In mailbox mode, slow controllers drop frames instead, so this
+        doesn't wait for them.
+        """
+        if not self.mailbox:
+            for server_id, (queue_, proc) in self.sessions.items():
+                self.wait_for_worker_idle(server_id, proc)
+        self.update_commit_skew()
+
+    def wait_for_worker_idle(self, server_id, proc):
+        done = self.cmds_done[server_id]
+        while self.cmds_finished[server_id] < self.cmds_put[server_id]:
+            if done.acquire(timeout=0 if not proc.is_alive()
+                            else self.put_timeout):
+                self.cmds_finished[server_id] += 1
+            elif not proc.is_alive():
+                logging.error("controller %s died" % server_id)
+                # Nothing else it was given will ever be finished
+                self.cmds_finished[server_id] = self.cmds_put[server_id]
+                return
 
     def chunk_payload_with_linenum(self, server_id, cmd, args, payload):
-        loops = 0
+        if self.mailbox:
+            self.pending_frames.setdefault(server_id, []).append(
+                (cmd, args, payload))
+            return
+        self.put_command(server_id, (cmd, args, payload))
 
+    def post_frames(self):
+        """
+        Replace the frame in each controller's mailbox with the frame which
+        has just been completed.
+        """
+        for server_id, commands in self.pending_frames.items():
+            queue_, proc = self.sessions[server_id]
+            try:
+                _, stale, _ = queue_.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                # The controller will never finish with the stale frame
+                self.cmds_finished[server_id] += 1
+                self.drop_frame(server_id, stale)
+            self.put_command(server_id, (MAILBOX_FRAME, commands, None))
+        self.pending_frames = OrderedDict()
+
+    def drop_frame(self, server_id, commands):
+        """
+        @overrides TeleCortexBaseManager.drop_frame
+
+        The controller will never sample a dropped canvas frame, so the
+        parent releases the buffer instead.
+        """
+        super(TelecortexThreadManager, self).drop_frame(server_id, commands)
+        for cmd, args, payload in commands:
+            if cmd == CANVAS_FRAME:
+                self.canvas_dropped_seqs[server_id] = max(
+                    self.canvas_dropped_seqs.get(server_id, -1), args)
+                self.canvas_sampled[server_id].release()
+
+    def put_command(self, server_id, item):
         while True:
-            loops += 1
-            if loops > 1000:
-                raise UserWarning(
-                    "too many retries: %s, %s" % (
-                        loops, map(str, [server_id, cmd, args, payload])
-                    )
-                )
+            queue_, proc = self.sessions[server_id]
             try:
-                self.sessions[server_id][0].put(
-                    (cmd, args, payload),
-                    timeout=0
+                queue_.put(
+                    item,
+                    timeout=self.put_timeout
                 )
             except queue.Full as exc:
-                logging.debug("Queue Full: %d | %s" % (server_id, exc))
-                # TODO: relinquish control to other sessions
-                self.relinquish()
+                if proc.is_alive():
+                    raise UserWarning(
+                        "queue full for %ss: %s, %s" % (
+                            self.put_timeout, server_id, item[0]
+                        )
+                    )
+                logging.error("controller %s died" % server_id)
+                self.refresh_connections([server_id])
+                continue
             except OSError as exc:
                 logging.error("OSError: %s" % exc)
                 self.refresh_connections([server_id])
                 continue
             except Exception as exc:
                 raise UserWarning("unhandled exception: %s" % str(exc))
+            self.cmds_put[server_id] += 1
             break
 
 
@@ -334,32 +1028,75 @@ class TeleCortexVirtualThreadManager(
     serial_class = TelecortexVirtualManagerMixin.serial_class
     session_class = TelecortexVirtualManagerMixin.session_class
     get_serial_conf = TelecortexVirtualManagerMixin.get_serial_conf
+    get_serial_confs = TelecortexVirtualManagerMixin.get_serial_confs
+
+
+class TelecortexThreadPoolManager(TelecortexThreadManager):
+    """
+    Manage TelecortexSession objects in multiple threads of this process.
+
+    pyserial releases the GIL while it reads and writes, so controllers can
+    be driven concurrently without the startup time, memory and pickling of
+    a process per controller.
+    """
+    cpu_clock = staticmethod(time.thread_time)
+
+    def get_context(self):
+        return TelecortexThreadContext
+
+    def stop_worker(self, server_id):
+        """
+        @overrides TelecortexThreadManager.stop_worker
+
+        Threads can't be terminated, so they are asked to stop.
+        """
+        queue_, proc = self.sessions[server_id]
+        if proc.is_alive():
+            queue_.put(None, timeout=self.put_timeout)
+            proc.join(self.put_timeout)
+
+
+class TeleCortexVirtualThreadPoolManager(
+    TelecortexThreadPoolManager, TelecortexVirtualManagerMixin
+):
+    serial_class = TelecortexVirtualManagerMixin.serial_class
+    session_class = TelecortexVirtualManagerMixin.session_class
+    get_serial_conf = TelecortexVirtualManagerMixin.get_serial_conf
+    get_serial_confs = TelecortexVirtualManagerMixin.get_serial_confs
 
 
 class TeleCortexCacheManager(TeleCortexBaseManager):
-    def __init__(self, servers, cache_file):
-        super(TeleCortexCacheManager, self).__init__(servers)
+    """
+    Record the commands which would be sent to each server to a file instead
+    of sending them, so that expensive renders can be replayed cheaply.
+    """
+    def __init__(self, servers, cache_file, **kwargs):
+        recorder_kwargs = dict([
+            (key, kwargs.pop(key)) for key in [
+                'delta', 'compress_level', 'keyframe_interval'
+            ] if key in kwargs
+        ])
+        super(TeleCortexCacheManager, self).__init__(servers, **kwargs)
         self.cache_file = cache_file
-        with open(self.cache_file, 'w') as cache:
-            cache.write('')
+        self.recorder = TelecortexRecorder(self.cache_file, **recorder_kwargs)
 
     def chunk_payload_with_linenum(self, server_id, cmd, args, payload):
-        with open(self.cache_file, 'a') as cache:
-            pass
-            # TODO: fix this
-            # print(
-            #     "%s: %s" % (
-            #         server_id,
-            #         ", ".join(map(str, [
-            #             cmd, json.dumps(args), payload
-            #         ]))
-            #     ), file=cache
-            # )
+        self.recorder.record_command(server_id, cmd, args, payload)
+
+    def commit_frame(self, server_ids=None):
+        self.recorder.record_commit()
+
+    def wait_for_workers_idle(self):
+        pass
+
+    def close(self):
+        self.recorder.close()
 
     @property
     def any_alive(self):
         return True
 
+    @property
     def all_idle(self):
         return True
 
@@ -373,8 +1110,24 @@ class TelecortexAsyncManager(TeleCortexBaseManager):
     """
     protocol_class = TelecortexSerialProtocol
 
+    executor_classes = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
+
     def __init__(self, conf, graphics, **kwargs):
         self.queue_len = kwargs.pop('queue_len', 10)
+        # Kind of executor which frame producers are run in
+        self.frame_executor = kwargs.pop('frame_executor', 'thread')
+        # Maximum number of frames being produced ahead of the current frame
+        self.frames_in_flight = kwargs.pop('frames_in_flight', 2)
+        # Executor which frame producers are run in, created when needed
+        self.executor = None
+        # Sequence number of the last frame sent by run_frame_producer_async
+        self.frame_seq = -1
+        # Time to wait for a controller to acknowledge a frame before
+        # carrying on without it
+        self.idle_timeout = kwargs.pop('idle_timeout', 5.0)
         self.conf = conf
         self.graphics = graphics
         super(TelecortexAsyncManager, self).__init__(conf.servers, **kwargs)
@@ -405,13 +1158,15 @@ class TelecortexAsyncManager(TeleCortexBaseManager):
         assert sys.version_info > (3, 7), (
             "async only works properly on python 3.7")
 
+        serial_confs = self.get_serial_confs(self.servers)
         for server_id, server_info in self.servers.items():
             if server_id not in self.cmd_queues:
-                self.cmd_queues[server_id] = asyncio.Queue(self.queue_len)
+                self.cmd_queues[server_id] = asyncio.Queue(
+                    1 if self.mailbox else self.queue_len)
 
             if server_id in self.sessions:
                 self.sessions[server_id].cancel()
-            serial_kwargs = self.get_serial_conf(server_info)
+            serial_kwargs = serial_confs[server_id]
             serial_url = serial_kwargs.pop('port', None)
             if serial_url is None:
                 continue
@@ -444,17 +1199,173 @@ class TelecortexAsyncManager(TeleCortexBaseManager):
         # TODO: implement this
         return True
 
-    async def relinquish_async(self):
-        await asyncio.sleep(self.manager_relinquish)
-
     async def wait_for_workers_idle_async(self):
-        while not self.all_idle:
-            logging.debug("waiting on queue idle")
-            await self.relinquish_async()
+        """
+        Frame barrier: wait until every controller has taken all of the
+        commands in its queue and acknowledged the last of them.
+
+        Each session marks a queued command as done once its last line is
+        acknowledged, so this wakes as soon as the slowest controller
+        acknowledges its commit, without polling. Controllers which have not
+        acknowledged everything within idle_timeout are not waited for, so
+        one silent controller can't hold up every frame.
+        """
+        joins = OrderedDict([
+            (asyncio.ensure_future(queue.join()), server_id)
+            for server_id, queue in self.cmd_queues.items()
+        ])
+        if not joins:
+            return
+        _, pending = await asyncio.wait(
+            list(joins.keys()), timeout=self.idle_timeout)
+        for join in pending:
+            join.cancel()
+            logging.warning(
+                "server %s did not finish its commands in %ss" % (
+                    joins[join], self.idle_timeout))
 
     async def chunk_payload_with_linenum_async(
         self, server_id, cmd, args, payload
     ):
+        """
+        Queue a command to be sent to a server.
+
+        Return a future which resolves to the (kind, fields) of the
+        controller's response to the last line of the command.
+        """
+        done = self.loop.create_future()
+        if self.mailbox:
+            self.pending_frames.setdefault(server_id, []).append(
+                (cmd, args, payload, done))
+            return done
         await self.cmd_queues[server_id].put(
-            (cmd, args, payload)
+            (cmd, args, payload, done)
         )
+        return done
+
+    async def post_frames_async(self):
+        """
+        Replace the frame in each session's mailbox with the frame which has
+        just been completed.
+        """
+        pending_frames = self.pending_frames
+        self.pending_frames = OrderedDict()
+        for server_id, commands in pending_frames.items():
+            queue_ = self.cmd_queues[server_id]
+            try:
+                _, stale, _, _ = queue_.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            else:
+                queue_.task_done()
+                self.drop_frame(server_id, stale)
+                for cmd, args, payload, done in stale:
+                    if not done.done():
+                        done.set_result(None)
+            await queue_.put((MAILBOX_FRAME, commands, None, None))
+
+    async def commit_frame_async(self, server_ids=None):
+        """
+        Queue an M2610 for each server. Once every session has written what
+        was queued before it, they all write their M2610 at the same time.
+
+        Return an awaitable which resolves to the responses of each server
+        once every controller has acknowledged the end of the frame.
+        """
+        if server_ids is None:
+            server_ids = list(self.sessions.keys())
+        if self.mailbox:
+            # Sessions are not held back by each other in mailbox mode
+            futures = []
+            for server_id in server_ids:
+                futures.append(await self.chunk_payload_with_linenum_async(
+                    server_id, "M2610", None, None
+                ))
+            await self.post_frames_async()
+            return asyncio.gather(*futures)
+        barrier = TelecortexCommitBarrier(len(server_ids))
+        barrier.done.add_done_callback(
+            lambda done: self.record_commit_skew(done.result()))
+        futures = []
+        for server_id in server_ids:
+            futures.append(await self.chunk_payload_with_linenum_async(
+                server_id, COMMIT_FRAME, (barrier, server_id), None
+            ))
+        return asyncio.gather(*futures)
+
+    def get_executor(self, args=()):
+        """
+        Create the executor, giving `args` to each of its workers once so
+        they are not sent again with every frame.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = self.executor_classes[self.frame_executor](
+            max_workers=self.frames_in_flight,
+            initializer=set_producer_args,
+            initargs=(args,)
+        )
+        return self.executor
+
+    async def send_frame_async(self, frame):
+        """
+        Queue the commands of a frame, then commit it on each server.
+
+        `frame` is an iterable of (server_id, cmd, args, payload) tuples.
+        Commands for servers which are not connected are skipped.
+        """
+        server_ids = []
+        for server_id, cmd, args, payload in frame:
+            if server_id not in self.sessions:
+                continue
+            if server_id not in server_ids:
+                server_ids.append(server_id)
+            await self.chunk_payload_with_linenum_async(
+                server_id, cmd, args, payload
+            )
+        return await self.commit_frame_async(server_ids)
+
+    async def run_frame_producer_async(self, producer, *args):
+        """
+        Run `producer(seq, *args)` in the executor to produce each frame,
+        and send the frames in order.
+
+        Up to `frames_in_flight` frames are produced ahead of the frame being
+        sent, so rendering, sampling and encoding happen off the event loop,
+        which only does I/O and scheduling. Frames can be produced in any
+        order, so the producer is given `seq`, the number of the frame
+        counting from 0, to animate by instead of the time. The producer
+        returns a frame for `send_frame_async`, or None to stop.
+
+        `args` are given to each worker once, when the executor is created.
+        With a process executor, the producer and its arguments must be
+        picklable.
+        """
+        executor = self.get_executor(args)
+        pending = deque()
+        seq = 0
+        while self.any_alive:
+            while len(pending) < self.frames_in_flight:
+                pending.append(self.loop.run_in_executor(
+                    executor, run_producer, producer, seq
+                ))
+                seq += 1
+            frame = await pending.popleft()
+            if frame is None:
+                break
+            if not self.mailbox:
+                # In mailbox mode, slow sessions drop frames instead
+                await self.wait_for_workers_idle_async()
+            await self.send_frame_async(frame)
+            self.frame_seq += 1
+        for future in pending:
+            future.cancel()
+
+    async def run_in_executor_async(self, func, *args):
+        """
+        Run `func(*args)` in the executor which frames are produced in, e.g.
+        to render a preview without blocking the event loop.
+        """
+        if self.executor is None:
+            self.get_executor()
+        return await self.loop.run_in_executor(self.executor, func, *args)
@@ -0,0 +1,200 @@
+"""
+Parse the lines which are received from a Telecortex device.
+"""
+
+from __future__ import unicode_literals
+
+import re
+
+# Kinds of line which can be received from the controller
+IDLE = 'IDLE'
+LOO = 'LOO'
+SET = 'SET'
+COMMENT = 'COMMENT'
+LINE_OK = 'LINE_OK'
+LINE_ERROR = 'LINE_ERROR'
+LINE_RESPONSE = 'LINE_RESPONSE'
+ERROR = 'ERROR'
+RESEND = 'RESEND'
+UNKNOWN = 'UNKNOWN'
+
+# Patterns used to extract fields, keyed by the first character of the line
+RE_LOO_RATES = (
+    r";LOO: "
+    r"FPS:\s+([\d\.]+),?\s*"
+    r"CMD_RATE:\s+([\d\.]+)\s*cps,?\s*"
+    r"PIX_RATE:\s+([\d\.]+)\s*pps,?\s*"
+    r"QUEUE:\s+(\d+)\s*/\s*(\d+)"
+)
+RE_SET = r";SET: "
+# N<linenum> followed by one of: ": OK", ": E<errnum>: <err>", ": <response>"
+RE_LINE = r"N(\d+)(?::\s*OK|:?\s*E(\d+):\s*(.*)|:\s*(\S+))"
+RE_ERROR = r"E(\d+):\s*(.*)"
+RE_RESEND = r"RS\s+(\d+)"
+
+
+class TelecortexResponseParser(object):
+    """
+    Classify and extract the fields from a received line in a single pass.
+
+    Lines can be `str` or `bytes`. `parse` returns a tuple of the kind of line,
+    and a tuple of its fields, already converted to numbers where possible:
+
+    - IDLE: ()
+    - LOO: (fps, cmd_rate, pix_rate, queue_occ, queue_max)
+    - SET, COMMENT, UNKNOWN: (line,)
+    - LINE_OK: (linenum,)
+    - LINE_ERROR: (linenum, errnum, err)
+    - LINE_RESPONSE: (linenum, response)
+    - ERROR: (errnum, err)
+    - RESEND: (linenum,)
+    """
+
+    def __init__(self):
+        self.patterns = {}
+        for type_, compile_ in [
+            (str, re.compile),
+            (bytes, lambda pattern: re.compile(pattern.encode('ascii'))),
+        ]:
+            self.patterns[type_] = (
+                compile_(RE_LOO_RATES).match,
+                compile_(RE_SET).match,
+                compile_(RE_LINE).match,
+                compile_(RE_ERROR).match,
+                compile_(RE_RESEND).match,
+            )
+
+    @classmethod
+    def to_text(cls, value):
+        if isinstance(value, bytes):
+            return value.decode('ascii', errors='backslashreplace')
+        return value
+
+    def parse(self, line):
+        """
+        Classify a single line and extract its fields.
+        """
+        if isinstance(line, bytearray):
+            line = bytes(line)
+        match_loo, match_set, match_line, match_error, match_resend = \
+            self.patterns[type(line)]
+        first = line[:1]
+        if first in ('N', b'N'):
+            match = match_line(line)
+            if match:
+                linenum, errnum, err, response = match.groups()
+                if errnum is not None:
+                    return LINE_ERROR, (
+                        int(linenum), int(errnum), self.to_text(err))
+                if response is not None:
+                    return LINE_RESPONSE, (
+                        int(linenum), self.to_text(response))
+                return LINE_OK, (int(linenum),)
+        elif first in (';', b';'):
+            match = match_loo(line)
+            if match:
+                fps, cmd_rate, pix_rate, queue_occ, queue_max = match.groups()
+                return LOO, (
+                    float(fps), float(cmd_rate), float(pix_rate),
+                    int(queue_occ), int(queue_max)
+                )
+            if match_set(line):
+                return SET, (self.to_text(line),)
+            return COMMENT, (self.to_text(line),)
+        elif first in ('I', b'I'):
+            if line.startswith(IDLE if isinstance(line, str) else b'IDLE'):
+                return IDLE, ()
+        elif first in ('E', b'E'):
+            match = match_error(line)
+            if match:
+                errnum, err = match.groups()
+                return ERROR, (int(errnum), self.to_text(err))
+        elif first in ('R', b'R'):
+            match = match_resend(line)
+            if match:
+                return RESEND, (int(match.group(1)),)
+        return UNKNOWN, (self.to_text(line),)
+
+    def parse_lines(self, lines):
+        """
+        Classify and extract the fields of a batch of lines.
+        """
+        parse = self.parse
+        return [parse(line) for line in lines]
+
+
+class TelecortexLineBuffer(object):
+    """
+    Split data received from a controller into lines.
+
+    Data is copied into a preallocated `bytearray`, only newly received data
+    is searched for line endings, and each complete line is decoded once.
+    Empty lines are discarded.
+    """
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # Start of the partially complete line
+        self.start = 0
+        # End of the received data
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def make_room(self, length):
+        """
+        Ensure there is space for `length` more bytes at the end of the buffer.
+        """
+        pending = self.end - self.start
+        if pending + length > len(self.buffer):
+            size = max(2 * len(self.buffer), pending + length)
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        elif pending:
+            self.view[:pending] = bytes(self.view[self.start:self.end])
+        self.start = 0
+        self.end = pending
+
+    def feed(self, data):
+        """
+        Add received data to the buffer and return any complete lines.
+        """
+        length = len(data)
+        if not length:
+            return []
+        if self.end + length > len(self.buffer):
+            self.make_room(length)
+        search_start = self.end
+        self.view[self.end:self.end + length] = data
+        self.end += length
+
+        lines = []
+        find = self.buffer.find
+        newline = find(b'\n', search_start, self.end)
+        while newline >= 0:
+            if newline > self.start:
+                line = str(self.view[self.start:newline], 'utf-8', 'replace')
+                if '\r' in line:
+                    lines.extend(part for part in line.split('\r') if part)
+                else:
+                    lines.append(line)
+            self.start = newline + 1
+            newline = find(b'\n', self.start, self.end)
+        if self.start == self.end:
+            self.start = self.end = 0
+        return lines
+
+    def read_lines(self, ser):
+        """
+        Perform a single read of everything waiting on a serial port, and
+        return all of the complete lines.
+        """
+        waiting = ser.in_waiting
+        if not waiting:
+            return []
+        return self.feed(ser.read(waiting))
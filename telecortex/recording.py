@@ -0,0 +1,426 @@
+"""
+Record the commands sent to Telecortex controllers in a compact binary format.
+
+A recording is `RECORDING_MAGIC` followed by length-prefixed records. Each
+record is a `RECORD_HEADER` followed by the command, its arguments as JSON and
+its payload:
+
+- length: number of bytes in the record after the header
+- timestamp: seconds since the recording was started
+- server_id: the server which the command is sent to
+- kind: RECORD_COMMAND, or RECORD_COMMIT at the end of each frame
+- flags: how the payload is stored, a combination of PAYLOAD_ZLIB and
+  PAYLOAD_DELTA, or COMMIT_KEYFRAME for a RECORD_COMMIT
+- cmd_len, args_len: length of the command and the arguments
+
+Payloads are stored as raw pixel bytes instead of base64 text. A delta payload
+is XORed with the previous payload of the same command, arguments and server,
+so unchanged pixels are stored as zeros which zlib compresses well.
+
+When a recording is closed, a RECORD_INDEX record holding an `INDEX_DTYPE`
+array with the position of each frame is written, followed by an
+`INDEX_FOOTER` pointing to it, so frames can be found without reading the
+records before them.
+"""
+
+from __future__ import unicode_literals
+
+import base64
+import json
+import mmap
+import shutil
+import struct
+import time
+import zlib
+
+import numpy as np
+
+RECORDING_MAGIC = b'TCREC\x01'
+# length, timestamp, server_id, kind, flags, cmd_len, args_len
+RECORD_HEADER = struct.Struct('<IdHBBBH')
+INDEX_MAGIC = b'TCIDX'
+# offset of the index record, INDEX_MAGIC
+INDEX_FOOTER = struct.Struct('<Q5s')
+# Start and end offset, timestamp and keyframe flag of each frame
+INDEX_DTYPE = np.dtype([
+    ('start', '<u8'), ('end', '<u8'), ('timestamp', '<f8'), ('keyframe', 'u1')
+])
+
+# Kinds of record
+RECORD_COMMAND = 0
+RECORD_COMMIT = 1
+RECORD_INDEX = 2
+
+# Flags describing how the payload of a record is stored
+PAYLOAD_ZLIB = 1
+PAYLOAD_DELTA = 2
+
+# Flag of a commit record whose frame can be decoded without the frames
+# before it
+COMMIT_KEYFRAME = 1
+
+
+def xor_bytes(data, previous):
+    """XOR two bytes-like objects of the same length."""
+    return np.bitwise_xor(
+        np.frombuffer(data, dtype=np.uint8),
+        np.frombuffer(previous, dtype=np.uint8)
+    ).tobytes()
+
+
+def encode_args(args):
+    if not args:
+        return b''
+    return json.dumps(args, sort_keys=True).encode('ascii')
+
+
+def decode_args(data):
+    if not data:
+        return None
+    return json.loads(bytes(data).decode('ascii'))
+
+
+class TelecortexRecorder(object):
+    """
+    Write commands and frame commits to a recording file.
+    """
+
+    def __init__(self, path, **kwargs):
+        # Determines if payloads are stored as the difference from the
+        # previous payload of the same command
+        self.delta = kwargs.pop('delta', True)
+        # zlib compression level of payloads, 0 to store them uncompressed
+        self.compress_level = kwargs.pop('compress_level', 6)
+        # Number of frames between frames which are stored without deltas,
+        # so that a player can seek to them
+        self.keyframe_interval = kwargs.pop('keyframe_interval', 100)
+        # Time which record timestamps are relative to
+        self.start_time = kwargs.pop('start_time', None)
+        # Determines if a frame index is written when the recording is closed
+        self.write_index = kwargs.pop('write_index', True)
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(RECORDING_MAGIC)
+        # (start, end, timestamp, keyframe) of each committed frame
+        self.frames = []
+        # Offset of the first record of the frame being recorded
+        self.frame_start = len(RECORDING_MAGIC)
+        # Determines if the frame being recorded is the first since
+        # `previous` was reset, so no payload in it is a delta
+        self.keyframe = True
+        # Previous raw payload for each (server_id, cmd, args)
+        self.previous = {}
+
+    def get_timestamp(self, timestamp=None):
+        if timestamp is not None:
+            return timestamp
+        now = time.time()
+        if self.start_time is None:
+            self.start_time = now
+        return now - self.start_time
+
+    def encode_payload(self, key, data):
+        """
+        Convert raw pixel bytes to their stored form, and the flags describing
+        that form.
+        """
+        flags = 0
+        if data is None:
+            return flags, b''
+        if self.delta:
+            previous = self.previous.get(key)
+            self.previous[key] = data
+            if previous is not None and len(previous) == len(data):
+                data = xor_bytes(data, previous)
+                flags |= PAYLOAD_DELTA
+        if self.compress_level:
+            data = zlib.compress(data, self.compress_level)
+            flags |= PAYLOAD_ZLIB
+        return flags, data
+
+    def write_record(self, timestamp, server_id, kind, flags, cmd, args,
+                     data):
+        self.file.write(RECORD_HEADER.pack(
+            len(cmd) + len(args) + len(data),
+            timestamp, server_id, kind, flags, len(cmd), len(args)
+        ))
+        self.file.write(cmd)
+        self.file.write(args)
+        self.file.write(data)
+
+    def record_command(self, server_id, cmd, args, payload, timestamp=None):
+        """
+        Record a command with an optional base64 encoded payload.
+        """
+        if payload is not None:
+            payload = base64.b64decode(payload)
+        self.record_pixels(server_id, cmd, args, payload, timestamp)
+
+    def record_pixels(self, server_id, cmd, args, pixels, timestamp=None):
+        """
+        Record a command with an optional payload of raw pixel bytes.
+        """
+        cmd = cmd.encode('ascii')
+        args = encode_args(args)
+        flags, data = self.encode_payload((server_id, cmd, args), pixels)
+        self.write_record(
+            self.get_timestamp(timestamp), server_id, RECORD_COMMAND, flags,
+            cmd, args, data
+        )
+
+    def record_commit(self, timestamp=None):
+        """
+        Record the end of a frame.
+        """
+        timestamp = self.get_timestamp(timestamp)
+        flags = COMMIT_KEYFRAME if self.keyframe else 0
+        self.write_record(timestamp, 0, RECORD_COMMIT, flags, b'', b'', b'')
+        end = self.file.tell()
+        self.frames.append((self.frame_start, end, timestamp, self.keyframe))
+        self.frame_start = end
+        self.keyframe = False
+        if self.keyframe_interval and \
+                not len(self.frames) % self.keyframe_interval:
+            self.previous = {}
+            self.keyframe = True
+
+    def append_segment(self, path, frames):
+        """
+        Append the frames of a recording made with `write_index=False`.
+
+        `frames` is the `frames` attribute of the recorder which made it. The
+        segment has to start with a keyframe, i.e. be made by a new recorder,
+        and the frame being recorded must be empty.
+        """
+        shift = self.file.tell() - len(RECORDING_MAGIC)
+        with open(path, 'rb') as segment:
+            segment.seek(len(RECORDING_MAGIC))
+            shutil.copyfileobj(segment, self.file)
+        self.frames.extend([
+            (start + shift, end + shift, timestamp, keyframe)
+            for start, end, timestamp, keyframe in frames
+        ])
+        self.frame_start = self.file.tell()
+        self.previous = {}
+        self.keyframe = True
+
+    def write_frame_index(self):
+        index_offset = self.file.tell()
+        index = np.array(self.frames, dtype=INDEX_DTYPE)
+        self.write_record(
+            0, 0, RECORD_INDEX, 0, b'', b'', index.tobytes()
+        )
+        self.file.write(INDEX_FOOTER.pack(index_offset, INDEX_MAGIC))
+
+    def close(self):
+        if self.write_index:
+            self.write_frame_index()
+        self.file.close()
+
+
+class TelecortexRecording(object):
+    """
+    Read a recording through `mmap`.
+
+    The offsets of each frame are read from the frame index when the
+    recording is opened. If the recording has no index, e.g. because it was
+    not closed, it is indexed by skipping from one record header to the
+    next, taking the keyframe flag of each frame from its commit record.
+    Decoding can start from a keyframe.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            raise UserWarning("not a telecortex recording: %s" % path)
+        # (start, end, timestamp, keyframe) of each frame
+        self.frames = []
+        # Previous raw payload for each (server_id, cmd, args)
+        self.previous = {}
+        # Index of the frame which will be decoded next
+        self.position = 0
+        # Decoded command and arguments, keyed by their stored bytes
+        self.cmd_cache = {}
+        self.args_cache = {}
+        if not self.read_frame_index():
+            self.index_frames()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def read_frame_index(self):
+        """
+        Read the frame index at the end of the recording if it exists.
+        """
+        data = self.mmap
+        size = len(data)
+        if size < len(RECORDING_MAGIC) + INDEX_FOOTER.size:
+            return False
+        index_offset, magic = INDEX_FOOTER.unpack_from(
+            data, size - INDEX_FOOTER.size)
+        if magic != INDEX_MAGIC:
+            return False
+        length, _, _, kind, _, _, _ = RECORD_HEADER.unpack_from(
+            data, index_offset)
+        if kind != RECORD_INDEX:
+            return False
+        start = index_offset + RECORD_HEADER.size
+        index = np.frombuffer(
+            data[start:start + length], dtype=INDEX_DTYPE)
+        self.frames = index.tolist()
+        return True
+
+    def index_frames(self):
+        data = self.mmap
+        size = len(data)
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        pos = start = len(RECORDING_MAGIC)
+        while pos + header_size <= size:
+            length, timestamp, _, kind, flags, _, _ = unpack_from(data, pos)
+            pos += header_size + length
+            if kind == RECORD_INDEX:
+                break
+            if kind == RECORD_COMMIT:
+                self.frames.append(
+                    (start, pos, timestamp, bool(flags & COMMIT_KEYFRAME)))
+                start = pos
+
+    def get_timestamp(self, frame):
+        return self.frames[frame][2]
+
+    def get_keyframe(self, frame):
+        """
+        Get the last keyframe at or before `frame`.
+        """
+        while frame > 0 and not self.frames[frame][3]:
+            frame -= 1
+        return frame
+
+    def decode_frame(self, frame):
+        """
+        Decode the commands of a frame as a list of
+        (server_id, cmd, args, payload) tuples, where payload is base64
+        encoded bytes, ready to be given to a manager.
+
+        Frames have to be decoded in order from a keyframe, see `seek`.
+        """
+        start, end, _, _ = self.frames[frame]
+        data = self.mmap
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        commands = []
+        pos = start
+        while pos < end:
+            length, _, server_id, kind, flags, cmd_len, args_len = \
+                unpack_from(data, pos)
+            pos += header_size
+            record_end = pos + length
+            if kind != RECORD_COMMAND:
+                pos = record_end
+                continue
+            cmd_bytes = data[pos:pos + cmd_len]
+            pos += cmd_len
+            args_bytes = data[pos:pos + args_len]
+            pos += args_len
+            cmd = self.cmd_cache.get(cmd_bytes)
+            if cmd is None:
+                cmd = self.cmd_cache[cmd_bytes] = cmd_bytes.decode('ascii')
+            if args_bytes not in self.args_cache:
+                self.args_cache[args_bytes] = decode_args(args_bytes)
+            # Copy the cached arguments, sessions may modify them
+            args = self.args_cache[args_bytes]
+            if args is not None:
+                args = dict(args)
+            payload = None
+            if record_end > pos:
+                raw = data[pos:record_end]
+                if flags & PAYLOAD_ZLIB:
+                    raw = zlib.decompress(raw)
+                key = (server_id, cmd_bytes, args_bytes)
+                if flags & PAYLOAD_DELTA:
+                    raw = xor_bytes(raw, self.previous[key])
+                self.previous[key] = raw
+                payload = base64.b64encode(raw)
+            pos = record_end
+            commands.append((server_id, cmd, args, payload))
+        return commands
+
+    def seek(self, frame):
+        """
+        Prepare to decode `frame` next, decoding the frames since the last
+        keyframe before it so that deltas can be applied.
+        """
+        keyframe = self.get_keyframe(frame)
+        self.previous = {}
+        for skipped in range(keyframe, frame):
+            self.decode_frame(skipped)
+        self.position = frame
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.frames):
+            raise StopIteration()
+        commands = self.decode_frame(self.position)
+        self.position += 1
+        return commands
+
+    next = __next__
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+class TelecortexRecordingPlayer(object):
+    """
+    Play a recording through a manager, paced by the recorded timestamps.
+    """
+
+    def __init__(self, manager, recording, **kwargs):
+        # Playback speed relative to the speed it was recorded at
+        self.rate = kwargs.pop('rate', 1.0)
+        # Determines if playback restarts at the first frame once it ends
+        self.loop = kwargs.pop('loop', False)
+        self.manager = manager
+        self.recording = recording
+
+    def send_frame(self, commands):
+        for server_id, cmd, args, payload in commands:
+            if not self.manager.session_active(server_id):
+                continue
+            self.manager.chunk_payload_with_linenum(
+                server_id, cmd, args, payload
+            )
+        self.manager.commit_frame()
+
+    def play(self, start=0):
+        """
+        Play from frame `start` until the end of the recording, or forever
+        if looping.
+        """
+        recording = self.recording
+        if not len(recording):
+            return
+        recording.seek(start)
+        start_time = time.time()
+        first_timestamp = recording.get_timestamp(start)
+        while self.manager.any_alive:
+            if recording.position >= len(recording):
+                if not self.loop:
+                    break
+                recording.seek(0)
+                start_time = time.time()
+                first_timestamp = recording.get_timestamp(0)
+            frame_time = start_time + (
+                recording.get_timestamp(recording.position) - first_timestamp
+            ) / self.rate
+            commands = next(recording)
+            delay = frame_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.send_frame(commands)
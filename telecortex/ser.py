@@ -1,10 +1,20 @@
 """
 Serial stuff.
 """
+import json
 import logging
+import os
+import time
 from serial.tools import list_ports
 from collections import OrderedDict
 
+# File which TelecortexCidCache is kept in by default, in the user's cache
+# directory rather than whichever directory a script is run from
+DEFAULT_CID_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'telecortex', 'cids.json'
+)
+
 
 def find_serial_dev(vid=None, pid=None, ser=None):
     """
@@ -36,17 +46,23 @@ def find_serial_dev(vid=None, pid=None, ser=None):
         return target_device
 
 
-def query_serial_dev(vid=None, pid=None, ser=None, dev=None):
+def query_serial_dev(vid=None, pid=None, ser=None, dev=None,
+                     port_infos=None):
     """
     Given a Vendor ID and (optional) Product ID, return the serial ports which
     match these parameters
+
+    `port_infos` can be given if the serial ports have already been
+    enumerated with `list_ports.comports()`.
     """
     logging.debug(
         "Querying for: VID: %s, PID: %s, SER: %s, DEV: %s",
         repr(vid), repr(pid), repr(ser), repr(dev)
     )
+    if port_infos is None:
+        port_infos = list_ports.comports()
     matching_devs = []
-    for port_info in list_ports.comports():
+    for port_info in port_infos:
         logging.debug(
             "found a device: \ninfo: %s\nvars: %s",
             port_info.usb_info(),
@@ -71,6 +87,81 @@ def query_serial_dev(vid=None, pid=None, ser=None, dev=None):
         matching_devs.append(target_device)
     return matching_devs
 
+class TelecortexCidCache(object):
+    """
+    Remember the CID of the controller on each serial port between runs.
+
+    Entries are stored in a JSON file, keyed by everything known about where
+    the controller is plugged in: its USB location, serial number and
+    VID:PID. Device file names can change while a controller is plugged in,
+    so they are only used to tell apart controllers which have neither a
+    location nor a serial number. Entries which have not been seen for
+    max_age seconds are forgotten.
+    """
+
+    # Seconds after which an entry which has not been seen again expires
+    max_age = 30 * 24 * 60 * 60
+
+    def __init__(self, path):
+        self.path = path
+        # Map of key to {'cid', 'device', 'timestamp'}
+        self.entries = {}
+        self.load()
+
+    @classmethod
+    def get_key(cls, port_info):
+        parts = []
+        location = getattr(port_info, 'location', None)
+        if location:
+            parts.append("location:%s" % location)
+        if port_info.serial_number:
+            parts.append("serial:%s" % port_info.serial_number)
+        if port_info.vid is not None:
+            parts.append(
+                "vid_pid:%04X:%04X" % (port_info.vid, port_info.pid or 0))
+        if not (location or port_info.serial_number):
+            parts.append("device:%s" % port_info.device)
+        return " ".join(parts)
+
+    def load(self):
+        try:
+            with open(self.path) as cache:
+                self.entries = json.load(cache)
+        except (IOError, OSError, ValueError) as exc:
+            logging.debug("no CID cache at %s: %s" % (self.path, exc))
+            self.entries = {}
+        expired = time.time() - self.max_age
+        self.entries = dict([
+            (key, entry) for key, entry in self.entries.items()
+            if entry.get('timestamp', 0) >= expired
+        ])
+
+    def save(self):
+        # Write a new file and rename it, so a crash never leaves it truncated
+        tmp_path = "%s.tmp" % self.path
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_path, 'w') as cache:
+                json.dump(self.entries, cache, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            logging.warning(
+                "could not save CID cache to %s: %s" % (self.path, exc))
+
+    def get_cid(self, port_info):
+        entry = self.entries.get(self.get_key(port_info))
+        if entry is not None:
+            return entry.get('cid')
+
+    def set_cid(self, port_info, cid):
+        self.entries[self.get_key(port_info)] = {
+            'cid': cid,
+            'device': port_info.device,
+            'timestamp': time.time(),
+        }
+
 # to get these values:
 # pip install pyserial
 # python -m serial.tools.list_ports --verbose
@@ -7,13 +7,11 @@ import json
 import logging
 import os
 import queue
-import re
 import sys
+import threading
 import time
-import numpy
 from builtins import super
 from collections import OrderedDict, deque
-from copy import deepcopy
 from datetime import datetime
 from pprint import pformat, pprint
 from time import time as time_now
@@ -25,6 +23,12 @@ from kitchen.text import converters
 import serial_asyncio
 import six
 from context import telecortex
+from telecortex.encoding import (TelecortexEncoder, plan_payload_chunks,
+                                  to_wire_bytes, xor_prefix)
+from telecortex.parsing import (COMMENT, ERROR, IDLE, LINE_ERROR, LINE_OK,
+                                 LINE_RESPONSE, LOO, RESEND, SET,
+                                 TelecortexLineBuffer,
+                                 TelecortexResponseParser)
 from telecortex.ser import (DEFAULT_BAUD, DEFAULT_TIMEOUT, IGNORE_SERIAL_NO,
                             IGNORE_VID_PID, TEENSY_VID, find_serial_dev,
                             query_serial_dev)
@@ -35,22 +39,35 @@ PANEL_LENGTHS = [
     316, 260, 260, 260
 ]
 
+# Queued in place of a command to commit a frame (M2610) in sync with the
+# other controllers, once everything queued before it has been sent.
+COMMIT_FRAME = 'COMMIT'
+# Queued in mailbox mode along with all of the commands of a frame
+MAILBOX_FRAME = 'FRAME'
+
 
 class TelecortexCommand(object):
     """
     Base Telecortex Command.
     """
-    def __init__(self, cmd, args=None):
+    def __init__(self, cmd, args=None, payload_checksum=None):
         self.cmd = cmd
         self.args = args
+        # Checksum of the `V` argument, if it is already known
+        self.payload_checksum = payload_checksum
         self.bytes_occupied = None
+        # Bytes which were written to the controller for this command
+        self.encoded = None
 
     @classmethod
     def fmt_cmd_args(cls, cmd, args):
         if args:
             return " ".join(
                 [cmd] + [
-                    "%s%s" % (key, value) for key, value in args.items()
+                    "%s%s" % (key, bytes(value).decode('ascii'))
+                    if isinstance(value, (bytes, memoryview))
+                    else "%s%s" % (key, value)
+                    for key, value in args.items()
                 ]
             )
         return cmd
@@ -69,14 +86,24 @@ class TelecortexCommand(object):
             cmd = self.add_checksum(cmd)
         return cmd
 
+    def encode(self, encoder):
+        """
+        Encode this command as bytes using a `TelecortexEncoder`.
+        """
+        return encoder.encode(
+            self.cmd, self.args, payload_checksum=self.payload_checksum)
+
 
 class TelecortexLineCommand(TelecortexCommand):
     """
     Telecortex Command which has a linenumber
     """
-    def __init__(self, linenum, cmd, args=None):
-        super(TelecortexLineCommand, self).__init__(cmd, args)
+    def __init__(self, linenum, cmd, args=None, payload_checksum=None):
+        super(TelecortexLineCommand, self).__init__(
+            cmd, args, payload_checksum)
         self.linenum = linenum
+        # Resolved when the controller responds to this line, if used
+        self.future = None
 
     @classmethod
     def fmt_line_cmd_args(cls, line, cmd, args):
@@ -91,6 +118,125 @@ class TelecortexLineCommand(TelecortexCommand):
             cmd = self.add_checksum(cmd)
         return cmd
 
+    def encode(self, encoder):
+        """
+        @overrides TelecortexCommand.encode
+        """
+        return encoder.encode(
+            self.cmd, self.args, self.linenum, self.payload_checksum)
+
+
+class TelecortexAckWindow(object):
+    """
+    Line command objects which are yet to be acknowledged.
+
+    Commands are stored in order of line number, so that a command can be
+    found by its offset from the first line number, and an acknowledgement
+    retires every command up to its line number from the left.
+    """
+
+    def __init__(self):
+        # Command objects, the ones before `head` have been retired
+        self.commands = []
+        # Index of the first unacknowledged command in self.commands
+        self.head = 0
+        # Line number of the first unacknowledged command
+        self.first_linenum = 0
+        # Total bytes written for the unacknowledged commands
+        self.bytes_occupied = 0
+
+    def __len__(self):
+        return len(self.commands) - self.head
+
+    def __bool__(self):
+        return len(self) > 0
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, linenum):
+        return 0 <= linenum - self.first_linenum < len(self)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    @property
+    def last_linenum(self):
+        return self.first_linenum + len(self) - 1
+
+    def keys(self):
+        return range(self.first_linenum, self.first_linenum + len(self))
+
+    def values(self):
+        return itertools.islice(self.commands, self.head, None)
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def get(self, linenum, default=None):
+        if linenum in self:
+            return self.commands[self.head + linenum - self.first_linenum]
+        return default
+
+    def append(self, cmd_obj):
+        """
+        Add a command to the end of the window.
+
+        If the command's line number does not follow on from the last command
+        (e.g. after M110), the window is restarted at that line number.
+        """
+        if self and cmd_obj.linenum != self.last_linenum + 1:
+            logging.debug(
+                "restarting ack window at %d, discarding %s",
+                cmd_obj.linenum, self.keys()
+            )
+            # The discarded commands will never be acknowledged, so anything
+            # waiting for them is told they are finished with
+            for discarded in self.values():
+                future = getattr(discarded, 'future', None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+            self.clear()
+        if not self:
+            self.first_linenum = cmd_obj.linenum
+        self.commands.append(cmd_obj)
+        self.bytes_occupied += cmd_obj.bytes_occupied or 0
+
+    def retire(self, linenum):
+        """
+        Remove every command with a line number up to and including linenum.
+
+        Return the commands which were removed.
+        """
+        count = min(linenum - self.first_linenum + 1, len(self))
+        if count <= 0:
+            return []
+        retired = self.commands[self.head:self.head + count]
+        self.bytes_occupied -= sum([
+            cmd_obj.bytes_occupied or 0 for cmd_obj in retired
+        ])
+        self.head += count
+        self.first_linenum += count
+        if self.head == len(self.commands):
+            self.clear()
+        elif self.head > len(self.commands) // 2:
+            del self.commands[:self.head]
+            self.head = 0
+        return retired
+
+    def commands_from(self, linenum):
+        """
+        Get the commands from linenum onwards, without copying them.
+        """
+        start = self.head + max(linenum - self.first_linenum, 0)
+        return self.commands[start:]
+
+    def clear(self):
+        first_linenum = self.first_linenum + len(self)
+        self.commands = []
+        self.head = 0
+        self.first_linenum = first_linenum
+        self.bytes_occupied = 0
+
 
 class TelecortexBaseSession(object):
     """
@@ -100,40 +246,33 @@ class TelecortexBaseSession(object):
     they are queued in ack_queue until the acknowledgement or error for that
     command is received.
     """
-    re_error = r"^E(?P<errnum>\d+):\s*(?P<err>.*)"
-    re_line = r"^N(?P<linenum>\d+)"
-    re_line_ok = r"%s:\s*OK" % re_line
-    re_line_error = r"%s\s*" % re_line + re_error[1:]
-    re_line_response = r"%s:\s*(?P<response>\S+)" % re_line
-    re_resend = r"^RS\s+(?P<linenum>\d+)"
-    re_set = r"^;SET: "
-    re_loo = r"^;LOO: "
-    re_loo_rates = (
-        r"%s"
-        r"FPS:\s+(?P<fps>[\d\.]+),?\s*"
-        r"CMD_RATE:\s+(?P<cmd_rate>[\d\.]+)\s*cps,?\s*"
-        r"PIX_RATE:\s+(?P<pix_rate>[\d\.]+)\s*pps,?\s*"
-        r"QUEUE:\s+(?P<queue_occ>\d+)\s*/\s*(?P<queue_max>\d+)"
-    ) % re_loo
-
     def __init__(self, linecount=0, **kwargs):
         # Current linecount used as sequence number for error detection
         self.linecount = linecount
         # Lines which have been recieved but are yet to be processed
         self.line_queue = deque()
+        # Parsed lines which are yet to be handled
+        self.response_queue = deque()
+        # Classifies received lines and extracts their fields
+        self.parser = TelecortexResponseParser()
         # Command objects which are yet to be acknowledged
-        self.ack_queue = OrderedDict()
+        self.ack_queue = TelecortexAckWindow()
         # Responses attached to a line number which are not "OK" or "ERROR"
         self.responses = OrderedDict()
         # Controller ID as reported by controller
         self.cid = None
         # Partially complete received lines
-        self.line_buffer = ""
+        self.line_buffer = TelecortexLineBuffer()
         # Last line which was receieved
         self.last_line = None
         # Limits the number of commands which have yet to be acknoqledged
+        # until the controller reports the space in its command queue
         self.max_ack_queue = kwargs.get('max_ack_queue', 5)
         assert isinstance(self.max_ack_queue, six.integer_types)
+        # Limits the number of commands which have yet to be acknowledged,
+        # however much space the controller reports
+        self.max_credit = kwargs.get('max_credit') or 32
+        assert isinstance(self.max_credit, six.integer_types)
         # Determins if Cyclic Redundancy Check is added to commands
         self.do_crc = kwargs.get('do_crc', True)
         # Determines if acknowledgments are processed.
@@ -142,8 +281,35 @@ class TelecortexBaseSession(object):
         self.chunk_size = kwargs.get('chunk_size', 2000)
         # Maximum bytes allowed to sit in Serial.out_waiting
         self.ser_buf_size = kwargs.get('ser_buf_size', 10000)
+        # Maximum bytes written for commands which are yet to be acknowledged
+        self.max_bytes_in_flight = kwargs.get('max_bytes_in_flight') or (
+            self.chunk_size * self.max_credit)
+        # Time at which the last M2610 frame commit was written
+        self.last_commit_time = None
+        # Last (queue_occ, queue_max) of the command queue reported by ;LOO:,
+        # and the number of unacknowledged commands when it was reported
+        self.device_queue = None
+        # Determines if payload commands are buffered and written together
+        self.coalesce_writes = kwargs.get('coalesce_writes', True)
+        # Encoded commands which are yet to be written
+        self.out_buffer = bytearray()
+        # Number of writes and bytes written since the last frame commit
+        self.frame_writes = 0
+        self.frame_bytes = 0
+        # Number of writes and bytes written for the last committed frame
+        self.last_frame_writes = 0
+        self.last_frame_bytes = 0
+        # Number of writes and bytes written during this session
+        self.total_writes = 0
+        self.total_bytes = 0
         # Amount of time to wait for
         self.sesh_relinquish = kwargs.get('sesh_relinquish', 0.001)
+        # Encodes command objects to bytes, caching headers and checksums
+        self.encoder = TelecortexEncoder(do_crc=self.do_crc)
+        # Cached chunk plans, see get_chunk_plan
+        self.chunk_plans = {}
+        # The chunk_size which the cached chunk plans were made for
+        self.chunk_plan_size = self.chunk_size
 
     def get_line(self):
         """
@@ -151,6 +317,17 @@ class TelecortexBaseSession(object):
         """
         raise NotImplementedError()
 
+    def get_lines(self):
+        """
+        Retrieve all of the lines which have been received from the controller.
+        """
+        lines = []
+        line = self.get_line()
+        while line:
+            lines.append(line)
+            line = self.get_line()
+        return lines
+
     def set_linenum(self, linenum):
         """
         Set the line number used by the controller and this manager.
@@ -163,6 +340,12 @@ class TelecortexBaseSession(object):
         """
         raise NotImplementedError()
 
+    def write_lines(self, data):
+        """
+        Write lines which have already been encoded to the controller.
+        """
+        raise NotImplementedError()
+
     def get_cid(self):
         """
         Populate this instance's controller id by asking the controller
@@ -175,79 +358,102 @@ class TelecortexBaseSession(object):
         """
         raise NotImplementedError()
 
+    def wait_idle(self):
+        """
+        Block until everything handed to this session has been sent.
+        """
+        pass
+
     def close(self):
         """
         Close the connection to the controller
         """
         raise NotImplementedError()
 
-    def send_cmd_with_linenum(self, cmd, args=None):
+    def send_cmd_with_linenum(self, cmd, args=None, payload_checksum=None):
         """
         Send a command, expect an eventual acknowledgement.
         """
-        cmd_obj = TelecortexLineCommand(self.linecount, cmd, args)
+        cmd_obj = TelecortexLineCommand(
+            self.linecount, cmd, args, payload_checksum)
+        self.send_line_cmd_obj(cmd_obj)
+        return cmd_obj
+
+    def send_line_cmd_obj(self, cmd_obj):
+        """
+        Send a command object which already has a line number.
+        """
         self.send_cmd_obj(cmd_obj)
-        if not self.ignore_acks:
-            self.ack_queue[self.linecount] = cmd_obj
-        logging.debug("sending cmd with lineno, %s, ack_queue: %s" % (
-            repr(cmd_obj.fmt(checksum=self.do_crc)), self.ack_queue.keys()))
-        self.linecount += 1
+        self.queue_ack(cmd_obj)
 
-    def send_cmd_without_linenum(self, cmd, args=None):
-        cmd_obj = TelecortexCommand(cmd, args)
+    def queue_ack(self, cmd_obj):
+        """
+        Wait for the acknowledgement of a command which has just been sent.
+        """
+        if not self.ignore_acks:
+            self.ack_queue.append(cmd_obj)
+        logging.debug(
+            "sending cmd with lineno, %r, ack_queue: %s",
+            cmd_obj.encoded, self.ack_queue.keys())
+        self.linecount = cmd_obj.linenum + 1
+
+    def send_cmd_without_linenum(self, cmd, args=None, payload_checksum=None):
+        cmd_obj = TelecortexCommand(cmd, args, payload_checksum)
         self.send_cmd_obj(cmd_obj)
-        logging.debug("sending cmd without lineno %s" % (
-            repr(cmd_obj.fmt(checksum=self.do_crc))))
+        logging.debug("sending cmd without lineno %r", cmd_obj.encoded)
 
     def parse_response(self, line):
-        if line.startswith("IDLE"):
+        self.handle_response(*self.parser.parse(line))
+
+    def handle_response(self, kind, fields):
+        """
+        Act on a line which has been parsed by `TelecortexResponseParser`.
+        """
+        if kind == LINE_OK:
+            self.action_idle = False
+            self.handle_line_ok(*fields)
+        elif kind == IDLE:
             self.idles_recvd += 1
-        elif line.startswith(";"):
-            if re.match(self.re_loo_rates, line):
-                self.last_loo_rate = time_now()
-                match = re.search(self.re_loo_rates, line).groupdict()
-                pix_rate = int(match.get('pix_rate'))
-                cmd_rate = int(match.get('cmd_rate'))
-                fps = int(match.get('fps'))
-                queue_occ = int(match.get('queue_occ'))
-                queue_max = int(match.get('queue_max'))
-                logging.warning(
-                    (
-                        "CID: %2s FPS: %3s, CMD_RATE: %5d, PIX_RATE: %7d, "
-                        "QUEUE: %s") % (
-                        self.cid, fps, cmd_rate, pix_rate,
-                        "%s / %s" % (queue_occ, queue_max)
-                    )
+            if self.device_queue is not None:
+                # The controller's command queue is empty, and every command
+                # in flight is cleared from ack_queue
+                self.device_queue = (0, self.device_queue[1], 0)
+        elif kind == LOO:
+            self.last_loo_rate = time_now()
+            fps, cmd_rate, pix_rate, queue_occ, queue_max = fields
+            self.device_queue = (queue_occ, queue_max, len(self.ack_queue))
+            logging.warning(
+                (
+                    "CID: %2s FPS: %3s, CMD_RATE: %5d, PIX_RATE: %7d, "
+                    "QUEUE: %s") % (
+                    self.cid, fps, cmd_rate, pix_rate,
+                    "%s / %s" % (queue_occ, queue_max)
                 )
-            elif re.match(self.re_set, line):
-                logging.info(line)
-        elif line.startswith("N"):
+            )
+        elif kind == SET:
+            logging.info(fields[0])
+        elif kind == COMMENT:
+            pass
+        elif kind == LINE_ERROR:
+            self.action_idle = False
+            linenum, errnum, err = fields
+            self.handle_error(linenum=linenum, errnum=errnum, err=err)
+        elif kind == LINE_RESPONSE:
             self.action_idle = False
-            # either "N\d+: OK" or N\d+: E\d+:
-            if re.match(self.re_line_ok, line):
-                match = re.search(self.re_line_ok, line).groupdict()
-                self.handle_line_ok_match(match)
-            elif re.match(self.re_line_error, line):
-                match = re.search(self.re_line_error, line).groupdict()
-                self.handle_error(**match)
-            elif re.match(self.re_line_response, line):
-                match = re.search(self.re_line_response, line).groupdict()
-                self.handle_line_response(**match)
-        elif line.startswith("E"):
+            linenum, response = fields
+            self.handle_line_response(linenum=linenum, response=response)
+        elif kind == ERROR:
             self.action_idle = False
-            if re.match(self.re_error, line):
-                match = re.search(self.re_error, line).groupdict()
-                self.handle_error(**match)
-        elif line.startswith("RS"):
+            errnum, err = fields
+            self.handle_error(errnum=errnum, err=err)
+        elif kind == RESEND:
             self.action_idle = False
-            if re.match(self.re_resend, line):
-                match = re.search(self.re_resend, line).groupdict()
-                self.handle_resend(**match)
+            self.handle_resend(linenum=fields[0])
         else:
             logging.warn(
                 "CID: %s line not recognised:\n%s\n" % (
                     self.cid,
-                    repr(line.encode('ascii', errors='backslashreplace'))
+                    repr(fields[0].encode('ascii', errors='backslashreplace'))
                 )
             )
 
@@ -255,16 +461,17 @@ class TelecortexBaseSession(object):
         """
         Parse all of the lines in the incoming line queue in order.
 
-        Assume that controller may send many commands at the same time.
+        Assume that controller may send many commands at the same time, so all
+        available lines are parsed as a batch. Handlers can send commands,
+        which can call this method again, so parsed lines are queued to make
+        sure they are handled in order.
         """
-        line = self.get_line()
+        lines = self.get_lines()
+        self.response_queue.extend(self.parser.parse_lines(lines))
         self.idles_recvd = 0
         self.action_idle = True
-        while True:
-            if not line:
-                break
-            self.parse_response(line)
-            line = self.get_line()
+        while self.response_queue:
+            self.handle_response(*self.response_queue.popleft())
         if self.idles_recvd > 0:
             logging.info('Idle received x %s' % self.idles_recvd)
         if self.action_idle and self.idles_recvd:
@@ -273,96 +480,129 @@ class TelecortexBaseSession(object):
         # else:
         #     logging.debug("did not recieve IDLE")
 
-    def chunk_payload_with_linenum(self, cmd, static_args, payload=None):
-        if payload is None:
-            self.send_cmd_with_linenum(cmd, static_args)
-        offset = 0
-        while payload:
-            chunk_args = deepcopy(static_args)
-            if offset > 0:
-                chunk_args['S'] = offset
-            chunk_args['V'] = ''
-            skeleton_cmd = TelecortexLineCommand.fmt_line_cmd_args(
-                self.linecount,
-                cmd,
-                chunk_args
+    def chunk_pixels(self, cmd, static_args, offset, linenum=None):
+        """
+        Determine the number of pixels which fit in a chunk of a command.
+        """
+        chunk_args = dict(static_args or {})
+        if offset > 0:
+            chunk_args['S'] = offset
+        chunk_args['V'] = ''
+        header, _ = self.encoder.get_header(cmd, chunk_args)
+        skeleton_len = len(header)
+        if linenum is not None:
+            skeleton_len += len("N%d " % linenum)
+        # 4 bytes per pixel because base64 encoded 24bit RGB
+        pixels_left = int(
+            (self.chunk_size - skeleton_len - len(' ****\r\n')) / 4)
+
+        assert \
+            pixels_left > 0, \
+            (
+                "not enough bytes left to chunk cmd, skeleton: %s, "
+                "chunk_size: %s"
+            ) % (
+                header,
+                self.chunk_size
             )
-            # 4 bytes per pixel because base64 encoded 24bit RGB
-            pixels_left = int(
-                (self.chunk_size - len(skeleton_cmd) - len(' ****\r\n')) / 4)
+        return pixels_left
 
-            assert \
-                pixels_left > 0, \
-                (
-                    "not enough bytes left to chunk cmd, skeleton: %s, "
-                    "chunk_size: %s"
-                ) % (
-                    skeleton_cmd,
-                    self.chunk_size
+    def get_chunk_plan(self, cmd, static_args, payload_len, linenum=None):
+        """
+        Get the plan for chunking a payload, from the cache if possible.
+
+        Panel sizes don't change, so chunk boundaries only depend on the
+        number of digits in the line number, and on chunk_size.
+
+        The plan is made for the widest line number the chunks will use, so
+        it is still valid if chunks are sent with shorter line numbers.
+        """
+        if self.chunk_size != self.chunk_plan_size:
+            self.chunk_plans = {}
+            self.chunk_plan_size = self.chunk_size
+        width = len(str(linenum)) if linenum is not None else 0
+        static_key = tuple((static_args or {}).items())
+        while True:
+            key = (cmd, static_key, payload_len, self.chunk_size, width)
+            plan = self.chunk_plans.get(key)
+            if plan is None:
+                # any line number with this many digits has the same length
+                sample_linenum = 10 ** (width - 1) if width else None
+                chunk_args = dict(static_args or {})
+                plan = plan_payload_chunks(
+                    payload_len,
+                    lambda offset: self.chunk_pixels(
+                        cmd, chunk_args, offset, sample_linenum
+                    )
                 )
-            chunk_args['V'] = "".join(payload[:(pixels_left * 4)])
+                plan = self.chunk_plans[key] = tuple(
+                    (
+                        offset, start, end,
+                        dict(chunk_args, S=offset) if offset > 0
+                        else dict(chunk_args)
+                    )
+                    for offset, start, end in plan
+                )
+            if not width or len(str(linenum + len(plan) - 1)) <= width:
+                return plan
+            width += 1
 
-            self.send_cmd_with_linenum(
-                cmd,
-                chunk_args
-            )
+    def iter_chunk_args(self, cmd, static_args, payload, with_linenum=True):
+        """
+        Generate the args and payload checksum of each chunk of a payload.
 
-            payload = payload[(pixels_left * 4):]
-            offset += pixels_left
+        The `V` arg of each chunk is a `memoryview` slice of the payload, so
+        the payload is never copied.
+        """
+        payload = to_wire_bytes(payload)
+        prefix = xor_prefix(payload) if self.do_crc else None
+        plan = self.get_chunk_plan(
+            cmd, static_args, len(payload),
+            self.linecount if with_linenum else None
+        )
+
+        view = memoryview(payload)
+        for offset, start, end, chunk_args in plan:
+            chunk_args = dict(chunk_args)
+            chunk_args['V'] = view[start:end]
+            payload_checksum = None
+            if prefix is not None:
+                payload_checksum = prefix[start] ^ prefix[end]
+            yield chunk_args, payload_checksum
+
+    def chunk_payload_with_linenum(self, cmd, static_args, payload=None):
+        """
+        Send a command, splitting its payload into chunks which fit in
+        chunk_size. Return the command object of the last chunk.
+        """
+        if payload is None:
+            return self.send_cmd_with_linenum(cmd, static_args)
+        cmd_obj = None
+        for chunk_args, payload_checksum in self.iter_chunk_args(
+            cmd, static_args, payload
+        ):
+            cmd_obj = self.send_cmd_with_linenum(
+                cmd, chunk_args, payload_checksum)
+        return cmd_obj
 
     def chunk_payload_without_linenum(self, cmd, static_args, payload):
-        offset = 0
         if not static_args:
             static_args = {}
         if not payload:
             self.send_cmd_without_linenum(cmd, static_args)
-        while payload:
-            chunk_args = deepcopy(static_args)
-            if offset > 0:
-                chunk_args['S'] = offset
-            chunk_args['V'] = ''
-            skeleton_cmd = TelecortexCommand.fmt_cmd_args(
-                cmd,
-                chunk_args
-            )
-            # 4 bytes per pixel because base64 encoded 24bit RGB
-            pixels_left = int(
-                (self.chunk_size - len(skeleton_cmd) - len(' ****\r\n')) / 4)
-            assert \
-                pixels_left > 0, \
-                (
-                    "not enough bytes left to chunk cmd, skeleton: %s, "
-                    "chunk_size: %s"
-                ) % (
-                    skeleton_cmd,
-                    self.chunk_size
-                )
-            chunk_args['V'] = "".join(payload[:(pixels_left * 4)])
-
-            self.send_cmd_without_linenum(
-                cmd,
-                chunk_args
-            )
-
-            payload = payload[(pixels_left * 4):]
-            offset += pixels_left
+            return
+        for chunk_args, payload_checksum in self.iter_chunk_args(
+            cmd, static_args, payload, with_linenum=False
+        ):
+            self.send_cmd_without_linenum(cmd, chunk_args, payload_checksum)
 
     def clear_ack_queue(self):
         logging.info("clearing ack queue: %s" % self.ack_queue.keys())
-        self.ack_queue = OrderedDict()
+        self.ack_queue.clear()
 
-    def handle_line_ok_match(self, match):
-        try:
-            linenum = int(match.get('linenum'))
-        except ValueError:
-            linenum = None
+    def handle_line_ok(self, linenum):
         if linenum is not None:
-            deletable_linenums = []
-            for ack_linenum in self.ack_queue.keys():
-                if ack_linenum <= linenum:
-                    deletable_linenums.append(ack_linenum)
-            for ack_linenum in deletable_linenums:
-                del self.ack_queue[ack_linenum]
+            self.ack_queue.retire(linenum)
         else:
             logging.warn((
                 "received an acknowledgement "
@@ -428,23 +668,110 @@ class TelecortexBaseSession(object):
                 self.cid, linenum)
             logging.error(error)
             # raise UserWarning(error)
+        pending = self.ack_queue.commands_from(linenum)
         warning = "CID: %s resending %s" % (
             self.cid,
-            ", ".join([
-                "N%s" % line
-                for line in self.ack_queue.keys() if line >= linenum
-            ])
+            ", ".join(["N%s" % cmd_obj.linenum for cmd_obj in pending])
         )
         logging.warning(warning)
-        old_queue = deepcopy(self.ack_queue)
-        self.clear_ack_queue()
+        # Lines before the resend request were received
+        if linenum is not None:
+            self.handle_line_ok(linenum - 1)
+        self.ack_queue.clear()
+        # Buffered commands are pending, so they are resent below.
+        del self.out_buffer[:]
         self.linecount = linenum
-        for resend_linenum, resend_command in old_queue.items():
-            if resend_linenum >= self.linecount:
-                self.send_cmd_with_linenum(
-                    resend_command.cmd,
-                    resend_command.args
-                )
+        if pending and pending[0].linenum == linenum:
+            # Line numbers are unchanged, so the bytes which were originally
+            # written for these commands can be written again as they are.
+            self.write_lines(
+                b"".join([cmd_obj.encoded for cmd_obj in pending]))
+            for cmd_obj in pending:
+                self.ack_queue.append(cmd_obj)
+            self.linecount = pending[-1].linenum + 1
+            return
+        for cmd_obj in pending:
+            resent = TelecortexLineCommand(
+                self.linecount, cmd_obj.cmd, cmd_obj.args,
+                cmd_obj.payload_checksum
+            )
+            resent.future = cmd_obj.future
+            self.send_line_cmd_obj(resent)
+
+    @property
+    def bytes_in_flight(self):
+        """
+        Bytes which have been sent but not acknowledged by the controller.
+        """
+        return self.ack_queue.bytes_occupied
+
+    @property
+    def bytes_left(self):
+        """
+        Bytes which can be sent before waiting for acknowledgements.
+        """
+        return max(self.max_bytes_in_flight - self.bytes_in_flight, 0)
+
+    @property
+    def cmd_credit(self):
+        """
+        Number of commands which can be unacknowledged at once.
+
+        Once the controller has reported its command queue, this is enough to
+        fill the queue: the commands which were unacknowledged when it was
+        reported, plus the space which was left. Commands acknowledged since
+        then have left the queue and made space for as many more. Until then
+        it is max_ack_queue, and it is never more than max_credit.
+        """
+        if self.device_queue is None:
+            credit = self.max_ack_queue
+        else:
+            queue_occ, queue_max, unacked = self.device_queue
+            credit = unacked + queue_max - queue_occ
+        return max(min(credit, self.max_credit), 1)
+
+    def has_credit(self, bytes_len=0):
+        """
+        Determine if a command of bytes_len can be sent without waiting.
+        """
+        if self.ignore_acks:
+            return True
+        if not self.ack_queue:
+            # Always let a command through if nothing is in flight
+            return True
+        if len(self.ack_queue) >= self.cmd_credit:
+            return False
+        return self.bytes_left >= bytes_len
+
+    def count_write(self, bytes_len):
+        """
+        Update write counters after bytes_len is written to the controller.
+        """
+        self.frame_writes += 1
+        self.frame_bytes += bytes_len
+        self.total_writes += 1
+        self.total_bytes += bytes_len
+
+    def count_frame(self):
+        """
+        Update write counters after a frame is committed.
+        """
+        self.last_frame_writes = self.frame_writes
+        self.last_frame_bytes = self.frame_bytes
+        self.frame_writes = 0
+        self.frame_bytes = 0
+        logging.debug(
+            "CID: %s frame written in %d writes, %d bytes per write",
+            self.cid, self.last_frame_writes, self.bytes_per_write)
+
+    @property
+    def bytes_per_write(self):
+        """
+        Average number of bytes per write for the last committed frame.
+        """
+        if not self.last_frame_writes:
+            return 0
+        return self.last_frame_bytes // self.last_frame_writes
 
     @property
     def ready(self):
@@ -463,11 +790,140 @@ class TelecortexSession(TelecortexBaseSession):
     def __init__(self, ser, **kwargs):
         super(TelecortexSession, self).__init__(**kwargs)
         self.ser = ser
+        # Determines if a background I/O thread owns the serial port once
+        # payloads start being sent.
+        self.io_thread_enabled = kwargs.get('io_thread', False)
+        # Bounded queue of (method, args) for the I/O thread to call
+        self.io_queue = queue.Queue(kwargs.get('io_queue_len', 10))
+        # Amount of time the I/O thread waits for a payload before it checks
+        # for responses from the controller.
+        self.io_timeout = kwargs.get('io_timeout', 0.01)
+        self.io_thread = None
+        # Exception raised by something the I/O thread called, re-raised in
+        # the next thread which hands it work or waits for it
+        self.io_error = None
 
     @property
     def lines_avail(self):
         return self.ser.in_waiting
 
+    def start_io_thread(self):
+        """
+        Start a background thread which sends payloads from self.io_queue.
+
+        From then on, the thread owns the serial port and all of the session
+        state, so other threads should only use chunk_payload_with_linenum,
+        send_cmd_with_linenum, send_cmd_without_linenum, commit_frame,
+        wait_idle and close. Commands sent from other threads are handed to
+        the I/O thread, so their command objects are not returned, and an
+        error sending them is raised by the next of these calls instead.
+        """
+        if self.io_thread is not None:
+            return
+        self.io_thread = threading.Thread(
+            target=self.io_loop,
+            name="io_%s" % self.cid,
+            daemon=True
+        )
+        self.io_thread.start()
+
+    def io_loop(self):
+        """
+        Send payloads from self.io_queue, handle responses while idle.
+        """
+        while True:
+            try:
+                item = self.io_queue.get(timeout=self.io_timeout)
+            except queue.Empty:
+                self.flush_out()
+                if self.lines_avail:
+                    self.parse_responses()
+                continue
+            try:
+                if item is None:
+                    self.flush_out()
+                    return
+                method, args = item
+                method(*args)
+            except Exception as exc:
+                logging.error("CID: %s I/O thread: %s" % (self.cid, exc))
+                if self.io_error is None:
+                    self.io_error = exc
+            finally:
+                self.io_queue.task_done()
+
+    @property
+    def in_io_thread(self):
+        return threading.current_thread() is self.io_thread
+
+    def raise_io_error(self):
+        """
+        Raise the first exception from the I/O thread since the last call.
+        """
+        exc, self.io_error = self.io_error, None
+        if exc is not None:
+            raise exc
+
+    def put_io(self, method, *args):
+        """
+        Hand a call to the I/O thread, raising any error from earlier calls.
+        """
+        self.raise_io_error()
+        self.io_queue.put((method, args))
+
+    def chunk_payload_with_linenum(self, cmd, static_args, payload=None):
+        """
+        @overrides TelecortexBaseSession.chunk_payload_with_linenum
+
+        In I/O thread mode, hand the payload to the I/O thread, blocking only
+        if io_queue is full, and return None.
+        """
+        if self.io_thread_enabled and not self.in_io_thread:
+            self.start_io_thread()
+            self.put_io(
+                self.chunk_payload_with_linenum, cmd, static_args, payload)
+            return
+        return super(TelecortexSession, self).chunk_payload_with_linenum(
+            cmd, static_args, payload)
+
+    def send_cmd_with_linenum(self, cmd, args=None, payload_checksum=None):
+        """
+        @overrides TelecortexBaseSession.send_cmd_with_linenum
+
+        While the I/O thread is running, other threads hand the command to
+        it, and no command object is returned.
+        """
+        if self.io_thread is not None and not self.in_io_thread:
+            self.put_io(
+                self.send_cmd_with_linenum, cmd, args, payload_checksum)
+            return
+        return super(TelecortexSession, self).send_cmd_with_linenum(
+            cmd, args, payload_checksum)
+
+    def send_cmd_without_linenum(self, cmd, args=None, payload_checksum=None):
+        """
+        @overrides TelecortexBaseSession.send_cmd_without_linenum
+
+        While the I/O thread is running, other threads hand the command to
+        it.
+        """
+        if self.io_thread is not None and not self.in_io_thread:
+            self.put_io(
+                self.send_cmd_without_linenum, cmd, args, payload_checksum)
+            return
+        return super(TelecortexSession, self).send_cmd_without_linenum(
+            cmd, args, payload_checksum)
+
+    def wait_idle(self):
+        """
+        @overrides TelecortexBaseSession.wait_idle
+
+        Raise any error from what the I/O thread was handed.
+        """
+        if self.io_thread is not None:
+            self.io_queue.join()
+            self.raise_io_error()
+
     def relinquish(self):
         """
         Potentially relinquish control to other sessions.
@@ -494,17 +950,71 @@ class TelecortexSession(TelecortexBaseSession):
         """
         @overrides TelecortexBaseSession.send_cmd_obj
         """
-        full_cmd = cmd_obj.fmt(checksum=self.do_crc)
-        while any([
-            self.lines_avail,
-            len(self.ack_queue) >= self.max_ack_queue
-            # self.bytes_left < len(full_cmd),
-            # self.last_idle - time_now() > 1,
-            # self.last_loo_rate - time_now() > 1
-        ]):
-            self.parse_responses()
-        cmd_obj.bytes_occupied = self.write_line(full_cmd)
+        full_cmd = cmd_obj.encode(self.encoder)
+        self.wait_credit(len(full_cmd))
+        self.buffer_cmd_obj(cmd_obj, full_cmd)
+
+    def wait_credit(self, bytes_len):
+        """
+        Block until a command of bytes_len can be sent.
+        """
+        while True:
+            if self.lines_avail or self.line_queue:
+                self.parse_responses()
+            if self.has_credit(bytes_len):
+                return
+            # Out of credit, so everything in flight must actually be written,
+            # then block until the controller acknowledges something.
+            self.flush_out()
+            self.wait_lines()
+
+    def buffer_cmd_obj(self, cmd_obj, full_cmd):
+        """
+        Add an encoded command to the output buffer, writing the buffer
+        straight away unless the command is a panel payload chunk.
+        """
+        cmd_obj.encoded = full_cmd
+        cmd_obj.bytes_occupied = len(full_cmd)
+        self.out_buffer += full_cmd
         self.last_cmd = cmd_obj
+        if not (
+            self.coalesce_writes
+            and isinstance(cmd_obj, TelecortexLineCommand)
+            and cmd_obj.args and 'V' in cmd_obj.args
+        ):
+            # Anything other than a panel payload chunk, e.g. the M2610 frame
+            # commit, is written straight away along with the buffer.
+            self.flush_out()
+            if cmd_obj.cmd == "M2610":
+                self.count_frame()
+
+    def commit_frame(self):
+        """
+        Send M2610 and write it straight away along with anything still
+        buffered, without waiting for credit, so that commits to several
+        controllers can be released together. The time it was written is
+        kept in last_commit_time.
+
+        While the I/O thread is running, other threads hand the commit to it,
+        and no command object is returned.
+        """
+        if self.io_thread is not None and not self.in_io_thread:
+            self.put_io(self.commit_frame)
+            return
+        cmd_obj = TelecortexLineCommand(self.linecount, "M2610")
+        self.buffer_cmd_obj(cmd_obj, cmd_obj.encode(self.encoder))
+        self.last_commit_time = time_now()
+        self.queue_ack(cmd_obj)
+        return cmd_obj
+
+    def flush_out(self):
+        """
+        Write all of the buffered commands to the controller.
+        """
+        if self.out_buffer:
+            data = self.out_buffer
+            self.out_buffer = bytearray()
+            self.write_line(data)
 
     def flush_in(self):
         # wiggle DTR and CTS (only works with AVR boards)
@@ -518,25 +1028,30 @@ class TelecortexSession(TelecortexBaseSession):
         while self.lines_avail:
             self.get_line()
 
-    def reset_board(self):
+    def reset_board(self, timeout=None):
         """
         @overrides TelecortexBaseSession.reset_board
+
+        If `timeout` is given, raise UserWarning if the controller has not
+        acknowledged the reset within that many seconds.
         """
         self.last_idle = time_now()
         self.last_loo_rate = time_now()
         self.ser.reset_output_buffer()
         self.send_cmd_without_linenum("M9999")
         self.flush_in()
-        self.set_linenum(0)
+        self.set_linenum(0, timeout)
 
-    def get_cid(self):
+    def get_cid(self, timeout=None):
         """
         @overrides TelecortexBaseSession.get_cid
+
+        If `timeout` is given, raise UserWarning if the controller has not
+        responded within that many seconds.
         """
         linenum = self.linecount
         self.send_cmd_with_linenum("P2205")
-        while linenum not in self.responses:
-            self.parse_responses()
+        self.wait_until(lambda: linenum in self.responses, timeout)
         response = self.responses.get(linenum)
         assert \
             response.startswith('S'), \
@@ -544,7 +1059,7 @@ class TelecortexSession(TelecortexBaseSession):
         self.cid = response[1:]
         return self.cid
 
-    def set_linenum(self, linenum):
+    def set_linenum(self, linenum, timeout=None):
         """
         @overrides TelecortexBaseSession.set_linenum
         """
@@ -554,29 +1069,50 @@ class TelecortexSession(TelecortexBaseSession):
         )
         self.linecount = linenum + 1
 
-        while self.ack_queue:
+        self.wait_until(lambda: not self.ack_queue, timeout)
+
+    def wait_until(self, condition, timeout=None):
+        """
+        Handle responses until `condition()` is true, blocking on the serial
+        port between checks.
+
+        If `timeout` is given, raise UserWarning if `condition()` is still
+        false after that many seconds.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time_now() + timeout
+        while True:
             self.parse_responses()
+            if condition():
+                return
+            if deadline is not None and time_now() > deadline:
+                raise UserWarning(
+                    "CID: %s timed out waiting for the controller" % self.cid)
+            self.flush_out()
+            self.wait_lines()
 
     def write_line(self, text):
-        # byte_array = serial.to_bytes(text)
-        if not text[-1] == '\n':
-            text = text + '\n'
-        # assert isinstance(text, six.text_type), "text should be text_type"
-        # if six.PY3:
-        #     byte_array = six.binary_type(text, 'latin-1')
-        # if six.PY2:
-        #     byte_array = six.binary_type(text)
-
-        bytes_ = converters.to_bytes(text)
+        """
+        Write a line of text or pre-encoded bytes to the controller.
+        """
+        if isinstance(text, six.text_type):
+            text = converters.to_bytes(text)
+        bytes_ = text
+        if not bytes_.endswith(b'\n'):
+            bytes_ = bytes_ + b'\n'
         bytes_len = len(bytes_)
+        bytes_ = memoryview(bytes_)
 
-        while bytes_:
+        while len(bytes_):
             buf_left = self.ser_buf_size - self.ser.out_waiting
-            buf_left = numpy.clip(buf_left, 0, len(bytes_))
+            buf_left = min(max(buf_left, 0), len(bytes_))
             # logging.debug("writing partial: %s" % (repr(bytes_[:buf_left]),))
-            self.ser.write(bytes_[:buf_left])
+            if buf_left:
+                self.ser.write(bytes_[:buf_left])
+                self.count_write(buf_left)
             bytes_ = bytes_[buf_left:]
-            if bytes_:
+            if len(bytes_):
                 logging.debug("waiting on write out: %d = %d - %d" % (
                     buf_left,
                     self.ser_buf_size,
@@ -586,51 +1122,82 @@ class TelecortexSession(TelecortexBaseSession):
 
         return bytes_len
 
+    def write_lines(self, data):
+        """
+        @overrides TelecortexBaseSession.write_lines
+        """
+        return self.write_line(data)
+
     def get_line(self):
         """
         @overrides TelecortexBaseSession.get_line
         """
         while self.ser.in_waiting:
-            data = self.ser.read_all()
-            self.line_buffer += converters.to_unicode(data)
-
-        if self.line_buffer:
-            lines = re.split(r"[\r\n]+", self.line_buffer)
-            self.line_queue.extend(lines[:-1])
-            self.line_buffer = lines[-1]
+            self.line_queue.extend(self.line_buffer.read_lines(self.ser))
 
         if self.line_queue:
             line = self.line_queue.popleft()
-            logging.debug("%s received line: %s" % (self.cid, line))
+            logging.debug("%s received line: %s", self.cid, line)
             self.last_line = line
             return line
 
-    @property
-    def bytes_left(self):
-        ser_buf_len = self.ser.out_waiting
-        if not self.ignore_acks and len(self.ack_queue) >= self.max_ack_queue:
-            return 0
-        if self.ignore_acks:
-            for linenum, ack_cmd in self.ack_queue.items():
-                if ack_cmd.cmd == "M110":
-                    return 0
-                ser_buf_len += ack_cmd.bytes_occupied
-                if ser_buf_len > self.ser_buf_size:
-                    return 0
-        return self.ser_buf_size - ser_buf_len
+    def get_lines(self):
+        """
+        @overrides TelecortexBaseSession.get_lines
+        """
+        while self.ser.in_waiting:
+            self.line_queue.extend(self.line_buffer.read_lines(self.ser))
+
+        lines = list(self.line_queue)
+        self.line_queue.clear()
+        if lines:
+            logging.debug("%s received lines: %s", self.cid, lines)
+            self.last_line = lines[-1]
+        return lines
+
+    def wait_lines(self):
+        """
+        Block until data is received from the controller, or the serial
+        port's read timeout expires. Return True if any data was received.
+        """
+        if self.ser.in_waiting:
+            return True
+        data = self.ser.read(1)
+        if data:
+            self.line_queue.extend(self.line_buffer.feed(data))
+        return bool(data)
+
+    def wait_ready(self):
+        """
+        Block until the session is ready for more commands.
+
+        Instead of sleeping between checks, this waits on the serial port, so
+        it wakes as soon as the controller acknowledges something.
+        """
+        if self.io_thread is not None:
+            # Putting on a full io_queue already blocks
+            return
+        while not self.ready:
+            self.flush_out()
+            self.wait_lines()
+            self.parse_responses()
 
     @property
     def ready(self):
+        if self.io_thread is not None:
+            return not self.io_queue.full()
         if self.ser.out_waiting >= self.ser_buf_size:
             return False
-        if not self.ignore_acks and len(self.ack_queue) >= self.max_ack_queue:
-            return False
-        return True
+        return self.has_credit()
 
     def __nonzero__(self):
         return bool(self.ser)
 
     def close(self):
+        if self.io_thread is not None:
+            self.io_queue.put(None)
+            self.io_thread.join()
+            self.io_thread = None
         self.ser.close()
 
 
@@ -655,6 +1222,25 @@ class VirtualTelecortexSession(TelecortexSession):
     def bytes_left(self):
         return self.chunk_size * 2
 
+    @property
+    def bytes_in_flight(self):
+        return 0
+
+    def reset_board(self, timeout=None):
+        """
+        @overrides TelecortexSession.reset_board
+        """
+        self.last_idle = time_now()
+        self.last_loo_rate = time_now()
+        self.set_linenum(0)
+
+    def get_cid(self, timeout=None):
+        """
+        @overrides TelecortexSession.get_cid
+        """
+        self.cid = self.ser.get('port')
+        return self.cid
+
     def parse_responses(self):
         if self.ack_queue:
             self.clear_ack_queue()
@@ -680,6 +1266,37 @@ class ThreadedTelecortexSession(TelecortexSession):
         time.sleep(self.sesh_relinquish)
 
 
+class TelecortexCommitBarrier(object):
+    """
+    Release the M2610 frame commit of several protocols at the same time.
+
+    Each protocol waits on the barrier once everything before the commit has
+    been written, and the last one to arrive releases them all in the same
+    iteration of the event loop.
+    """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.arrived = 0
+        self.release = asyncio.Event()
+        # Map of server_id to the time at which each protocol wrote its
+        # commit
+        self.commit_times = OrderedDict()
+        # Resolved once every party has committed
+        self.done = asyncio.get_event_loop().create_future()
+
+    async def wait(self):
+        self.arrived += 1
+        if self.arrived >= self.parties:
+            self.release.set()
+        await self.release.wait()
+
+    def record_commit(self, key):
+        self.commit_times[key] = time_now()
+        if len(self.commit_times) >= self.parties and not self.done.done():
+            self.done.set_result(self.commit_times)
+
+
 class TelecortexSerialProtocol(asyncio.Protocol, TelecortexBaseSession):
     """
     A serial protocol, which uses a `serial_asyncio.SerialTransport`, is
@@ -697,8 +1314,15 @@ class TelecortexSerialProtocol(asyncio.Protocol, TelecortexBaseSession):
         TelecortexBaseSession.__init__(self, *args, **kwargs)
         # Asyncio queue containing commands to be run
         self.cmd_queue = queue_
-        # Since serial writes are parallelized, must have a mutex.
-        self.serial_lock = asyncio.Lock()
+        # Set while the transport's write buffer is below its high-water mark
+        self.writable = asyncio.Event()
+        self.writable.set()
+        # Set when there is data in self.out_buffer for write_loop
+        self.out_ready = asyncio.Event()
+        # Futures resolved with the response to a line number, e.g. "S1"
+        self.response_waiters = {}
+        # Set when responses are handled, which may give more credit
+        self.credit_changed = asyncio.Event()
 
     def connection_made(self, transport):
         """
@@ -712,6 +1336,9 @@ class TelecortexSerialProtocol(asyncio.Protocol, TelecortexBaseSession):
         # transport.serial.rts = False
         # Write serial data via transport
         # transport.write(b'Hello, World!\n')
+        self.transport.set_write_buffer_limits(high=self.ser_buf_size)
+
+        asyncio.create_task(self.write_loop())
 
         self.reset_board()
 
@@ -721,25 +1348,142 @@ class TelecortexSerialProtocol(asyncio.Protocol, TelecortexBaseSession):
 
     async def cmd_queue_loop(self):
         while True:
+            # Stop taking commands while the transport is paused, so that
+            # the manager's queue fills up and blocks the producer.
+            await self.writable.wait()
             try:
-                cmd, args, payload = await self.cmd_queue.get()
-                self.chunk_payload_with_linenum(cmd, args, payload)
+                item = await self.cmd_queue.get()
             except Exception as exc:
                 logging.error(exc)
+                continue
+            if item[0] == MAILBOX_FRAME:
+                items = item[1]
+            else:
+                items = [item]
+            cmd_obj = None
+            for cmd, args, payload, done in items:
+                cmd_obj = await self.run_queued_cmd(cmd, args, payload, done)
+            if cmd_obj is None:
+                self.cmd_queue.task_done()
+                continue
+            # The item is finished with once its last line is acknowledged,
+            # which is what the manager's frame barrier waits on.
+            cmd_obj.future.add_done_callback(
+                lambda _: self.cmd_queue.task_done())
+
+    async def run_queued_cmd(self, cmd, args, payload, done):
+        """
+        Send a command taken from cmd_queue, and resolve `done` once its
+        last line is acknowledged. Return its last command object.
+        """
+        try:
+            if cmd == COMMIT_FRAME:
+                barrier, server_id = args
+                await barrier.wait()
+                cmd_obj = self.commit_frame()
+                barrier.record_commit(server_id)
+            else:
+                cmd_obj = await self.send_payload_async(cmd, args, payload)
+        except Exception as exc:
+            logging.error(exc)
+            cmd_obj = None
+        if cmd_obj is None:
+            if done is not None and not done.done():
+                done.set_result(None)
+        elif done is not None:
+            self.chain_future(cmd_obj.future, done)
+        return cmd_obj
+
+    async def wait_credit_async(self):
+        """
+        Wait until a command of up to chunk_size can be sent.
+        """
+        while not self.has_credit(self.chunk_size):
+            self.credit_changed.clear()
+            await self.credit_changed.wait()
+
+    async def send_payload_async(self, cmd, static_args, payload=None):
+        """
+        Send a command like chunk_payload_with_linenum, waiting for credit
+        before each chunk. Return the command object of the last chunk.
+        """
+        if payload is None:
+            await self.wait_credit_async()
+            return self.send_cmd_with_linenum(cmd, static_args)
+        cmd_obj = None
+        for chunk_args, payload_checksum in self.iter_chunk_args(
+            cmd, static_args, payload
+        ):
+            await self.wait_credit_async()
+            cmd_obj = self.send_cmd_with_linenum(
+                cmd, chunk_args, payload_checksum)
+        return cmd_obj
+
+    @classmethod
+    def chain_future(cls, future, done):
+        """
+        Resolve `done` with the result of `future` once it is resolved.
+        """
+        def callback(future):
+            if done.done():
+                return
+            if future.cancelled():
+                done.cancel()
+            else:
+                done.set_result(future.result())
+        future.add_done_callback(callback)
+
+    @classmethod
+    def resolve_future(cls, cmd_obj, kind, fields):
+        """
+        Resolve the future of a command with the response which it received.
+        """
+        future = getattr(cmd_obj, 'future', None)
+        if future is not None and not future.done():
+            future.set_result((kind, fields))
+
+    async def write_loop(self):
+        """
+        The only coroutine which writes to the transport apart from
+        commit_frame, which writes everything buffered before its commit, so
+        writes are in order. Everything buffered while the transport is
+        paused is written together once it resumes.
+        """
+        while True:
+            await self.out_ready.wait()
+            self.out_ready.clear()
+            await self.writable.wait()
+            self.flush_out()
+
+    def flush_out(self):
+        """
+        Write all of the buffered commands to the transport.
+        """
+        if not self.out_buffer:
+            return
+        data = self.out_buffer
+        self.out_buffer = bytearray()
+        self.transport.write(data)
+        self.count_write(len(data))
+
+    def commit_frame(self):
+        """
+        Send M2610 and write it to the transport straight away, along with
+        anything still buffered. Return its command object.
+        """
+        cmd_obj = self.chunk_payload_with_linenum("M2610", None)
+        self.flush_out()
+        return cmd_obj
 
     def data_received(self, data):
         """
         Provide Asyncio with Callback for when data is received.
         """
-        logging.debug('data received %s' % repr(data))
-        self.line_buffer += converters.to_unicode(data)
-
-        if '\n' in self.line_buffer:
-            lines = re.split(r"[\r\n]+", self.line_buffer)
-            self.line_queue.extend(lines[:-1])
-            self.line_buffer = lines[-1]
+        logging.debug('data received %r', data)
+        self.line_queue.extend(self.line_buffer.feed(data))
 
         self.parse_responses()
+        self.credit_changed.set()
 
     def get_line(self):
         """
@@ -758,60 +1502,101 @@ class TelecortexSerialProtocol(asyncio.Protocol, TelecortexBaseSession):
         logging.warning('port closed')
         self.transport.loop.stop()
 
-    # def pause_writing(self):
-    #     logging.debug('pause writing')
-    #     logging.debug(self.transport.get_write_buffer_size())
-    #
-    # def resume_writing(self):
-    #     logging.debug(self.transport.get_write_buffer_size())
-    #     logging.debug('resume writing')
-
-    async def relinquish_async(self):
-        await asyncio.sleep(0.005)
-
-    async def write_line_async(self, text):
+    def pause_writing(self):
         """
-        Async here because Serial.write blocks?
+        Provide Asyncio with Callback for when the write buffer is full.
         """
-        logging.debug("sending text: %s" % repr(text))
-        if not text[-1] == '\n':
-            text = text + '\n'
-        # bytes_ = six.binary_type(text, 'latin-1')
-        # bytes_ = text.encode('utf8')
-        bytes_ = converters.to_bytes(text)
-        bytes_len = len(bytes_)
+        logging.debug(
+            'pause writing: %d', self.transport.get_write_buffer_size())
+        self.writable.clear()
 
-        async with self.serial_lock:
-            while bytes_:
-                buf_left = self.ser_buf_size - self.transport.serial.out_waiting
-                buf_left = numpy.clip(buf_left, 0, len(bytes_))
-                # logging.debug("writing partial: %s" % (repr(bytes_[:buf_left]),))
-                self.transport.serial.write(bytes_[:buf_left])
-                bytes_ = bytes_[buf_left:]
-
-                if bytes_:
-                    logging.debug("waiting on write out: %d = %d - %d" % (
-                        buf_left,
-                        self.ser_buf_size,
-                        self.transport.serial.out_waiting
-                    ))
-                    await self.relinquish_async()
-        return bytes_len
+    def resume_writing(self):
+        """
+        Provide Asyncio with Callback for when the write buffer has drained.
+        """
+        logging.debug(
+            'resume writing: %d', self.transport.get_write_buffer_size())
+        self.writable.set()
 
-    # def write_line(self, text):
-    #     """
-    #     """
-    #     asyncio.create_task(
+    def write_lines(self, data):
+        """
+        @overrides TelecortexBaseSession.write_lines
+        """
+        self.out_buffer += data
+        self.out_ready.set()
 
     def send_cmd_obj(self, cmd_obj):
         """
         @overrides TelecortexBaseSession.send_cmd_obj
         """
-        full_cmd = cmd_obj.fmt(checksum=self.do_crc)
-        cmd_obj.bytes_occupied = asyncio.create_task(
-            self.write_line_async(full_cmd))
+        full_cmd = cmd_obj.encode(self.encoder)
+        cmd_obj.encoded = full_cmd
+        cmd_obj.bytes_occupied = len(full_cmd)
+        self.write_lines(full_cmd)
         self.last_cmd = cmd_obj
 
+    def send_line_cmd_obj(self, cmd_obj):
+        """
+        @overrides TelecortexBaseSession.send_line_cmd_obj
+
+        Give the command a future which resolves to the (kind, fields) of the
+        controller's response to the line.
+        """
+        if cmd_obj.future is None:
+            cmd_obj.future = asyncio.get_event_loop().create_future()
+        super(TelecortexSerialProtocol, self).send_line_cmd_obj(cmd_obj)
+        if self.ignore_acks:
+            self.resolve_future(cmd_obj, LINE_OK, (cmd_obj.linenum,))
+
+    def handle_line_ok(self, linenum):
+        """
+        @overrides TelecortexBaseSession.handle_line_ok
+        """
+        if linenum is None:
+            return super(TelecortexSerialProtocol, self).handle_line_ok(
+                linenum)
+        # Acknowledgements are cumulative, so every earlier line is retired.
+        for cmd_obj in self.ack_queue.retire(linenum):
+            self.resolve_future(cmd_obj, LINE_OK, (cmd_obj.linenum,))
+
+    def handle_line_response(self, **kwargs):
+        """
+        @overrides TelecortexBaseSession.handle_line_response
+        """
+        super(TelecortexSerialProtocol, self).handle_line_response(**kwargs)
+        linenum = kwargs.get('linenum')
+        waiter = self.response_waiters.pop(linenum, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(kwargs.get('response', ''))
+        self.resolve_future(
+            self.ack_queue.get(linenum), LINE_RESPONSE,
+            (linenum, kwargs.get('response', ''))
+        )
+
+    def handle_error(self, **kwargs):
+        """
+        @overrides TelecortexBaseSession.handle_error
+        """
+        linenum = kwargs.get('linenum')
+        errnum = kwargs.get('errnum')
+        # Lines with checksum or line number errors are resent later.
+        if linenum is not None and errnum not in [10, 19]:
+            self.resolve_future(
+                self.ack_queue.get(linenum), LINE_ERROR,
+                (linenum, errnum, kwargs.get('err'))
+            )
+        super(TelecortexSerialProtocol, self).handle_error(**kwargs)
+
+    def clear_ack_queue(self):
+        """
+        @overrides TelecortexBaseSession.clear_ack_queue
+
+        The controller is idle, so it has finished with every line in flight.
+        """
+        for cmd_obj in self.ack_queue.values():
+            self.resolve_future(cmd_obj, IDLE, ())
+        super(TelecortexSerialProtocol, self).clear_ack_queue()
+
     def set_linenum(self, linenum):
         """
         @overrides TelecortexBaseSession.set_linenum
@@ -834,12 +1619,12 @@ class TelecortexSerialProtocol(asyncio.Protocol, TelecortexBaseSession):
         Async here because has to wait for response from controller
         """
         linenum = self.linecount
+        # Wait for the response itself, since the line's future can resolve
+        # without it, e.g. when acknowledgements are ignored.
+        waiter = asyncio.get_event_loop().create_future()
+        self.response_waiters[linenum] = waiter
         self.send_cmd_with_linenum("P2205")
-        while linenum not in self.responses:
-            logging.debug(
-                '%d not in responses: %s' % (linenum, self.responses,))
-            await self.relinquish_async()
-        response = self.responses.get(linenum)
+        response = await waiter
 
         assert \
             response.startswith('S'), \
@@ -9,7 +9,7 @@ import six
 def pix_array2text(*pixels):
     """Convert an array of pixels to a base64 encoded unicode string."""
     pix_bytestring = b''.join([
-        six.int2byte(pixel % 256)
+        six.int2byte(int(pixel) % 256)
         for pixel in pixels
     ])
 